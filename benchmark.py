@@ -0,0 +1,418 @@
+#!/usr/local/python-3.4.1/bin/python3
+'''
+Purpose: Offline benchmarks of the scripts on synthetic data so performance changes can be measured across commits.
+
+Cases:
+    tradestore.*              queryTradestoreFiles on generated gzip tradestore day files
+    forex.mergeChanges        trackForexMarginChanges reading haircut .dat files, their last commit in a git repo and merging them
+    hkex.getDaylyFigure       getSehkntlTradeFigures.getDaylyFigure on HKEX daily stat pages served from a local http server
+    to_table.*                to_table.get_schema, split_into_files and write_frame into sqlite on a wide dataframe
+    writeDataFrame.sqlite     utilities.writeDataFrame into a local sqlite database
+
+Every case is run --repeat times and once more under tracemalloc for the peak memory. One json line per case is
+appended to the results file with the best/mean time, the peak memory and the git commit of the tree.
+Cases whose modules can't be imported (missing IBLog, git, bs4 ...) are reported as skipped.
+
+Usage:
+    python benchmark.py run [--cases tradestore,to_table] [--scale 1] [--repeat 3] [--results benchmarkResults.jsonl]
+    python benchmark.py compare [--base COMMIT] [--head COMMIT]    (default: the last two commits in the results)
+'''
+
+import os, sys
+import io
+import gc
+import json
+import argparse
+import logging
+import platform
+import subprocess
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime
+from time import perf_counter
+import numpy as np
+import pandas as pd
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.append(os.path.join(os.environ.get('HOME', ''), 'python_lib'))
+
+START_DATE = '20160104'
+FOREX_FILES = ['haircut_rates.dat', 'haircut_rates_ibca.dat', 'haircut_rates_nfa.dat']
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the scripts on synthetic data')
+    sub = parser.add_subparsers(dest='command')
+    run = sub.add_parser('run')
+    run.add_argument('--cases', default=None, help='comma separated case name prefixes, default all')
+    run.add_argument('--scale', type=float, default=1.0, help='multiplier of the synthetic data sizes')
+    run.add_argument('--repeat', type=int, default=3)
+    run.add_argument('--workdir', default=None, help='where the synthetic data is generated, default a dir in the temp dir')
+    run.add_argument('--results', default=os.path.join(here, 'benchmarkResults.jsonl'))
+    run.add_argument('--verbose', action='store_true', help='show the output of the benchmarked functions')
+    cmp = sub.add_parser('compare')
+    cmp.add_argument('--results', default=os.path.join(here, 'benchmarkResults.jsonl'))
+    cmp.add_argument('--base', default=None)
+    cmp.add_argument('--head', default=None)
+    cmp.add_argument('--threshold', type=float, default=10.0, help='time/memory increase in %% reported as a regression')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        # configured before getSehkntlTradeFigures is imported so its basicConfig doesn't truncate log/log.txt
+        logging.basicConfig(level=logging.WARNING)
+        workdir = args.workdir or os.path.join(tempfile.gettempdir(), 'benchmark.{:g}'.format(args.scale))
+        os.makedirs(workdir, exist_ok=True)
+        prefixes = args.cases.split(',') if args.cases else None
+        runBenchmarks(workdir, args.scale, args.repeat, args.results, prefixes, args.verbose)
+    elif args.command == 'compare':
+        compareResults(args.results, args.base, args.head, args.threshold)
+    else:
+        parser.print_help()
+
+def getCommit():
+    '''Returns the short commit of the tree and if it has uncommitted changes'''
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=here, stderr=subprocess.DEVNULL).decode().strip()
+        status = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=here).decode()
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+    return commit, len(status.strip()) > 0
+
+def runBenchmarks(workdir, scale, repeat, resultsFile, prefixes=None, verbose=False):
+    commit, dirty = getCommit()
+    for name, setup, run in CASES:
+        if prefixes and not any(name.startswith(p) for p in prefixes):
+            continue
+        try:
+            state = setup(workdir, scale)
+        except ImportError as e:
+            print('{:<28} skipped: {}'.format(name, e))
+            continue
+        try:
+            result = timeCase(run, state, repeat, verbose)
+        except Exception as e:
+            print('{:<28} failed: {!r}'.format(name, e))
+            continue
+        finally:
+            if 'cleanup' in state:
+                state['cleanup']()
+        result.update({'case': name, 'commit': commit, 'dirty': dirty, 'scale': scale, 'repeat': repeat,
+                       'date': '{:%Y-%m-%d %H:%M:%S}'.format(datetime.now()), 'python': platform.python_version(),
+                       'pandas': pd.__version__, 'host': platform.node()})
+        print('{:<28} best {:>8.3f}s  mean {:>8.3f}s  peak {:>8.1f}MB  rows {}'.format(name, result['best'], result['mean'],
+                                                                                       result['peakMB'], result['rows']))
+        with open(resultsFile, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+def timeCase(run, state, repeat, verbose):
+    '''Times repeat runs and measures the peak of the python allocations (numpy/pandas included)
+    in one more run under tracemalloc, so the tracing overhead isn't in the timings.
+    Memory of forked workers is not included.'''
+    out = sys.stdout if verbose else io.StringIO()
+    times = list()
+    rows = None
+    for i in range(repeat):
+        gc.collect()
+        with redirect_stdout(out):
+            ts = perf_counter()
+            rows = run(state)
+            times.append(perf_counter() - ts)
+        if not verbose:
+            out.seek(0)
+            out.truncate()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        with redirect_stdout(out):
+            run(state)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'best': min(times), 'mean': sum(times) / len(times), 'times': times, 'peakMB': peak / 1024 / 1024, 'rows': rows}
+
+def compareResults(resultsFile, base=None, head=None, threshold=10.0):
+    '''Prints the best time and peak memory of every case in the base and head commits'''
+    results = list()
+    with open(resultsFile) as f:
+        for line in f:
+            if line.strip():
+                results.append(json.loads(line))
+    label = lambda r: '{}{}'.format(r['commit'], '+' if r['dirty'] else '')
+    labels = list()
+    for r in results:
+        if label(r) not in labels:
+            labels.append(label(r))
+    if head is None:
+        head = labels[-1]
+    if base is None:
+        older = [l for l in labels if l != head]
+        if len(older) == 0:
+            raise Exception('Only one commit in {}, nothing to compare'.format(resultsFile))
+        base = older[-1]
+    best = dict()
+    for r in results:
+        if label(r) not in (base, head):
+            continue
+        key = (r['case'], r['scale'], label(r))
+        b = best.get(key)
+        best[key] = (min(r['best'], b[0]), min(r['peakMB'], b[1])) if b else (r['best'], r['peakMB'])
+
+    print('{:<28} {:>6} {:>10} {:>10} {:>8} {:>10} {:>10} {:>8}'.format('case', 'scale', base, head, 'time', 'base MB', 'head MB', 'memory'))
+    regressions = 0
+    for case, scale in sorted(set((k[0], k[1]) for k in best)):
+        b, h = best.get((case, scale, base)), best.get((case, scale, head))
+        if b is None or h is None:
+            print('{:<28} {:>6g} {:>10} {:>10}'.format(case, scale, fmt(b and b[0]), fmt(h and h[0])))
+            continue
+        dt = 100.0 * (h[0] - b[0]) / b[0] if b[0] > 0 else 0.0
+        dm = 100.0 * (h[1] - b[1]) / b[1] if b[1] > 0 else 0.0
+        flag = ''
+        if dt > threshold or dm > threshold:
+            flag = '  <- regression'
+            regressions += 1
+        print('{:<28} {:>6g} {:>10} {:>10} {:>+7.1f}% {:>10.1f} {:>10.1f} {:>+7.1f}%{}'.format(case, scale, fmt(b[0]), fmt(h[0]), dt, b[1], h[1], dm, flag))
+    print('{} regression(s) above {:g}%'.format(regressions, threshold))
+    return regressions
+
+def fmt(seconds):
+    return '-' if seconds is None else '{:.3f}s'.format(seconds)
+
+# tradestore ------------------------------------------------------------------------------------------
+
+def makeTradestoreFiles(dirName, days, rowsPerDay, seed=0):
+    '''Writes days gzip tradestore files of rowsPerDay trades each, starting at START_DATE.
+    About 1% of the trades repeat the first 3 parts of the previous exec id (duplicates) and 5% have 0 quantity.
+    Returns the file template.'''
+    template = os.path.join(dirName, 'trades.data.{0:%Y%m%d}.gz')
+    os.makedirs(dirName, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    accounts = np.array(['U{}'.format(1000000 + i) for i in range(max(100, rowsPerDay // 50))])
+    contracts = np.array(['SYM{}'.format(i) for i in range(2000)])
+    for n, dt in enumerate(pd.date_range(pd.to_datetime(START_DATE, format='%Y%m%d'), periods=days)):
+        file = template.format(dt)
+        if os.path.exists(file):
+            continue
+        ids = np.arange(n * rowsPerDay, (n + 1) * rowsPerDay) + 100000000
+        dup = rng.random_sample(rowsPerDay) < 0.01
+        dup[0] = False
+        ids[dup] = ids[np.flatnonzero(dup) - 1]
+        quantity = rng.randint(-500, 500, rowsPerDay) * 100
+        quantity[rng.random_sample(rowsPerDay) < 0.05] = 0
+        df = pd.DataFrame({
+            '#EXEC_ID': pd.Series(ids).astype(str) + '.1.' + pd.Series(rng.randint(1, 9, rowsPerDay)).astype(str) + '.' + np.where(dup, '2', '1'),
+            # a few accounts make most of the trades like in the real files
+            'ACCOUNT_ID': accounts[np.minimum(rng.zipf(1.3, rowsPerDay) - 1, len(accounts) - 1)],
+            'COMPANY_ID': rng.choice(['', 'IBLLC', 'IBUK', 'IBCAN', 'IBHK'], rowsPerDay, p=[0.4, 0.3, 0.1, 0.1, 0.1]),
+            'EXCHANGE_NAME': rng.choice(['NYSE', 'NASDAQ', 'ARCA', 'SEHK', 'LSE', 'IDEALPRO', 'GLOBEX'], rowsPerDay),
+            'CONTRACT': contracts[rng.randint(0, len(contracts), rowsPerDay)],
+            'CURRENCY': rng.choice(['USD', 'EUR', 'GBP', 'HKD', 'CAD'], rowsPerDay),
+            'QUANTITY': quantity,
+            'PRICE': np.round(rng.lognormal(3, 1, rowsPerDay), 4),
+            'COMMISSION': np.round(rng.random_sample(rowsPerDay) * 5, 2),
+            'TRADE_TIME': '{:%Y%m%d}-'.format(dt) + pd.Series(pd.to_timedelta(rng.randint(0, 86400, rowsPerDay), unit='s')).astype(str).str[-8:],
+            })
+        df.to_csv(file + '.tmp', sep='|', index=False, compression='gzip')
+        os.replace(file + '.tmp', file)
+    return template
+
+def setupTradestore(workdir, scale):
+    import utilities
+    template = makeTradestoreFiles(os.path.join(workdir, 'tradestore'), 5, int(200000 * scale))
+    utilities.TRADESTORE_FILE = template
+    endDate = '{:%Y%m%d}'.format(pd.to_datetime(START_DATE, format='%Y%m%d') + pd.Timedelta(days=4))
+    accounts = ['U{}'.format(1000000 + i) for i in range(0, 200, 10)]
+    return {'utilities': utilities, 'endDate': endDate, 'accounts': accounts}
+
+def runTradestoreFull(state):
+    return len(state['utilities'].queryTradestoreFiles(pd, START_DATE, state['endDate']))
+
+def runTradestoreWhere(state):
+    return len(state['utilities'].queryTradestoreFiles(pd, START_DATE, state['endDate'], columns=['ACCOUNT_ID', 'CONTRACT', 'QUANTITY', 'PRICE'],
+                                                       where=[('ACCOUNT_ID', 'in', state['accounts'])], skipZeroTrades=True))
+
+def runTradestoreDedupWorkers(state):
+    return len(state['utilities'].queryTradestoreFiles(pd, START_DATE, state['endDate'], dropDuplicateTrades=True, workers=4))
+
+# trackForexMarginChanges -----------------------------------------------------------------------------
+
+def makeForexRepo(dirName, pairs, seed=0):
+    '''Commits haircut files of pairs currency pairs in a git repo in dirName and changes about 5% of the rates,
+    removes 1% and adds 1% new pairs in the working copy'''
+    from itertools import product
+    from string import ascii_uppercase
+    if os.path.exists(os.path.join(dirName, '.git')):
+        return
+    os.makedirs(dirName, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    codes = [''.join(c) for c in product(ascii_uppercase, repeat=3)]
+    git = lambda *args: subprocess.check_call(['git', '-c', 'user.name=benchmark', '-c', 'user.email=benchmark@localhost'] + list(args),
+                                              cwd=dirName, stdout=subprocess.DEVNULL)
+    frames = dict()
+    for file in FOREX_FILES:
+        idx = rng.choice(len(codes) ** 2, pairs + pairs // 100, replace=False)
+        df = pd.DataFrame({'curr1': [codes[i // len(codes)] for i in idx], 'curr2': [codes[i % len(codes)] for i in idx],
+                           'margin': np.round(rng.uniform(0.01, 0.5, len(idx)), 3)})
+        frames[file] = df
+        writeHaircutFile(os.path.join(dirName, file), df.iloc[:pairs])
+    git('init', '-q')
+    git('add', *FOREX_FILES)
+    git('commit', '-q', '-m', 'initial rates')
+    for file, df in frames.items():
+        df = df.iloc[pairs // 100:].copy()
+        changed = rng.random_sample(len(df)) < 0.05
+        df.loc[changed, 'margin'] = np.round(df.loc[changed, 'margin'] * 1.5, 3)
+        writeHaircutFile(os.path.join(dirName, file), df)
+
+def writeHaircutFile(path, df):
+    with open(path, 'w') as f:
+        f.write('# curr1 curr2 margin\n')
+        for row in df.itertuples(index=False):
+            f.write('{}\t{}\t{}\n'.format(row.curr1, row.curr2, row.margin))
+
+def setupForex(workdir, scale):
+    import git
+    import trackForexMarginChanges
+    dirName = os.path.join(workdir, 'forexMarginChange')
+    makeForexRepo(dirName, int(2000 * scale))
+    return {'module': trackForexMarginChanges, 'repo': git.Repo(dirName), 'dirName': dirName}
+
+def runForexMergeChanges(state):
+    tfmc = state['module']
+    filesNew = tfmc.getFilesContent(state['dirName'], FOREX_FILES)
+    filesOld = tfmc.getCommittedFilesContent(state['repo'], FOREX_FILES)
+    filesToCommit = [file for (file, df) in filesNew.items() if not df.equals(filesOld[file])]
+    merged = tfmc.mergeOldAndNew(pd.concat([filesOld[f] for f in filesToCommit]), pd.concat([filesNew[f] for f in filesToCommit]),
+                                 datetime.now().date())
+    return len(merged)
+
+# getSehkntlTradeFigures ------------------------------------------------------------------------------
+
+def makeHkexPage(buyTrades, sellTrades, fillerRows):
+    '''HKEX daily stat page with the northbound table found by getDaylyFigure after fillerRows rows of other tables'''
+    filler = ''.join('<tr><td>Item {0}</td><td>{1:,}</td></tr>'.format(i, i * 37) for i in range(fillerRows))
+    return '''<html><head><title>Daily Statistics</title></head><body>
+<table><tr><td><div id="SBTitle">Southbound</div></td></tr><tr><td><table><tr><td><table>{filler}</table></td></tr></table></td></tr></table>
+<table>
+<tr><td><div id="NBTitle">Shanghai Connect Northbound</div></td></tr>
+<tr><td><table><tr><td><table>
+<tr><td>Total Turnover</td><td>12,345,678</td></tr>
+<tr><td>No. of Buy Trades</td><td>{buy:,}</td></tr>
+<tr><td>No. of Sell Trades</td><td>{sell:,}</td></tr>
+<tr><td>Daily Quota Balance</td><td>-</td></tr>
+</table></td></tr></table></td></tr>
+</table>
+<table>{filler}</table>
+</body></html>'''.format(filler=filler, buy=buyTrades, sell=sellTrades)
+
+def setupHkex(workdir, scale):
+    import threading
+    from functools import partial
+    from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+    import getSehkntlTradeFigures
+    dirName = os.path.join(workdir, 'hkex')
+    os.makedirs(dirName, exist_ok=True)
+    expected = 0
+    for i in range(5):
+        buy, sell = 100000 + i * 1111, 90000 + i * 777
+        expected += buy + sell
+        with open(os.path.join(dirName, 'd2016010{}e.htm'.format(4 + i)), 'w') as f:
+            f.write(makeHkexPage(buy, sell, int(500 * scale)))
+
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=dirName))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    urls = ['http://127.0.0.1:{}/d2016010{}e.htm'.format(server.server_address[1], 4 + i) for i in range(5)]
+
+    def cleanup():
+        server.shutdown()
+        server.server_close()
+    return {'module': getSehkntlTradeFigures, 'urls': urls, 'expected': expected, 'cleanup': cleanup}
+
+def runHkexDaylyFigure(state):
+    total = sum(state['module'].getDaylyFigure(url) for url in state['urls'])
+    if total != state['expected']:
+        raise Exception('getDaylyFigure returned {} trades, expected {}'.format(total, state['expected']))
+    return len(state['urls'])
+
+# to_table and writeDataFrame -------------------------------------------------------------------------
+
+def makeWideFrame(rows, seed=0):
+    '''Frame of 40 int, float, string and datetime columns with some nulls'''
+    rng = np.random.RandomState(seed)
+    data = dict()
+    for i in range(10):
+        data['INT_COL{}'.format(i)] = rng.randint(0, 10 ** (i % 9 + 1), rows)
+    for i in range(10):
+        col = rng.normal(1000, 250, rows)
+        col[rng.random_sample(rows) < 0.02] = np.nan
+        data['FLOAT_COL{}'.format(i)] = col
+    words = np.array(['ALPHA', 'BRAVO', 'CHARLIE', 'DELTA', 'ECHO', 'FOXTROT', 'GOLF', 'HOTEL', None])
+    for i in range(15):
+        data['STR_COL{}'.format(i)] = words[rng.randint(0, len(words), rows)] if i % 2 else \
+            pd.Series(rng.randint(0, 10 ** 6, rows)).astype(str).str.zfill(8 + i).values
+    base = pd.Timestamp(START_DATE)
+    for i in range(5):
+        data['DATE_COL{}'.format(i)] = base + pd.to_timedelta(rng.randint(0, 86400 * 365, rows), unit='s')
+    return pd.DataFrame(data)
+
+def setupToTable(workdir, scale):
+    import to_table
+    return {'module': to_table, 'df': makeWideFrame(int(100000 * scale))}
+
+def runToTableGetSchema(state):
+    # the statements are cached per table and columns, clear them so every run infers the schema
+    state['module'].schema_cache.clear()
+    state['module'].get_schema(state['df'], 'BENCHMARK', 'mysql')
+    return len(state['df'])
+
+def runToTableSplitIntoFiles(state):
+    files = state['module'].split_into_files(state['df'])
+    for f in files:
+        f.close()
+    return len(state['df'])
+
+def setupToTableSqlite(workdir, scale):
+    import to_table
+    import utilities
+    return {'module': to_table, 'df': makeWideFrame(int(100000 * scale)),
+            'conn': utilities.getDbConnection('SQLITE:{}'.format(os.path.join(workdir, 'write_frame.db')))}
+
+def runToTableWriteFrameSqlite(state):
+    state['module'].schema_cache.clear()
+    state['module'].write_frame(state['df'], 'BENCHMARK', state['conn'], 'sqlite', if_exists='replace')
+    return len(state['df'])
+
+def setupWriteDataFrameSqlite(workdir, scale):
+    import utilities
+    df = makeWideFrame(int(100000 * scale))
+    return {'utilities': utilities, 'df': df, 'db': os.path.join(workdir, 'writeDataFrame.db')}
+
+def runWriteDataFrameSqlite(state):
+    import sqlite3
+    df = state['df']
+    conn = sqlite3.connect(state['db'])
+    try:
+        conn.execute('drop table if exists BENCHMARK')
+        conn.execute('create table BENCHMARK ({})'.format(', '.join(df.columns)))
+        state['utilities'].writeDataFrame(conn, 'BENCHMARK', df)
+    finally:
+        conn.close()
+    return len(df)
+
+# (name, setup(workdir, scale) -> state, run(state) -> rows)
+CASES = [('tradestore.full', setupTradestore, runTradestoreFull),
+         ('tradestore.where', setupTradestore, runTradestoreWhere),
+         ('tradestore.dedupWorkers', setupTradestore, runTradestoreDedupWorkers),
+         ('forex.mergeChanges', setupForex, runForexMergeChanges),
+         ('hkex.getDaylyFigure', setupHkex, runHkexDaylyFigure),
+         ('to_table.get_schema', setupToTable, runToTableGetSchema),
+         ('to_table.split_into_files', setupToTable, runToTableSplitIntoFiles),
+         ('to_table.write_frame.sqlite', setupToTableSqlite, runToTableWriteFrameSqlite),
+         ('writeDataFrame.sqlite', setupWriteDataFrameSqlite, runWriteDataFrameSqlite)]
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+'''
+Hierarchical timing and metrics of the pipeline stages (tradestore days, getAcctsProperties chunks
+and tables, write_frame shards).
+
+Spans nest per thread. Every span has its wall time and counters like rows, bytes and roundTrips.
+The finished spans are exported as json lines or as a prometheus textfile (totals per span path).
+When metrics are not enabled span() returns a shared no-op span so the overhead is a flag check.
+
+Usage:
+    import metrics
+    metrics.enable('/home/mhristov/tmp/metrics.jsonl')            # or fmt='prom' for a textfile
+    with metrics.span('loadDay', day='20160104') as s:
+        ...
+        s.add(rows=len(df), bytes=os.path.getsize(file))
+    metrics.export()                                               # also done at exit
+Metrics are enabled at import if the environment variable METRICS_FILE is set (METRICS_FORMAT=jsonl|prom).
+'''
+import os
+import json
+import atexit
+import threading
+from time import time, perf_counter
+from functools import wraps
+
+settings = {'enabled': False, 'path': None, 'fmt': 'jsonl'}
+records = list()
+recordsLock = threading.Lock()
+# running totals per span path of the records exported to the prometheus textfile
+totals = dict()
+local = threading.local()
+
+class Span(object):
+    def __init__(self, name, parent, attrs):
+        self.name = name
+        self.parent = parent
+        self.path = name if parent is None else parent.path + '/' + name
+        self.attrs = attrs
+        self.counters = dict()
+        self.start = None
+        self.startTime = None
+
+    def add(self, **counters):
+        for k, v in counters.items():
+            self.counters[k] = self.counters.get(k, 0) + v
+
+    def __enter__(self):
+        stack().append(self)
+        self.startTime = time()
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = perf_counter() - self.start
+        s = stack()
+        if s and s[-1] is self:
+            s.pop()
+        addRecord(self.path, elapsed, self.startTime, self.counters, self.attrs, exc_info[0] is not None)
+        return False
+
+class NullSpan(object):
+    '''Span used when the metrics are disabled'''
+    path = None
+
+    def add(self, **counters):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_SPAN = NullSpan()
+
+def stack():
+    if not hasattr(local, 'stack'):
+        local.stack = list()
+    return local.stack
+
+def current():
+    '''Returns the innermost open span of the thread or None'''
+    s = stack()
+    return s[-1] if s else None
+
+def span(name, parent=None, **attrs):
+    '''Returns a span context manager. It nests in the innermost open span of the thread unless parent is given'''
+    if not settings['enabled']:
+        return NULL_SPAN
+    return Span(name, parent if parent is not None else current(), attrs)
+
+def add(**counters):
+    '''Adds counters to the innermost open span of the thread if any'''
+    if not settings['enabled']:
+        return
+    s = current()
+    if s is not None:
+        s.add(**counters)
+
+def record(name, elapsed, counters=None, parent=None, **attrs):
+    '''Records a span timed elsewhere, ex. in a worker process or around the yields of a generator'''
+    if not settings['enabled']:
+        return
+    parent = parent if parent is not None else current()
+    path = name if parent is None else parent.path + '/' + name
+    addRecord(path, elapsed, time() - elapsed, counters or {}, attrs, False)
+
+def addRecord(path, elapsed, startTime, counters, attrs, error):
+    rec = {'span': path, 'start': startTime, 'elapsed': elapsed, 'counters': counters, 'attrs': attrs,
+           'pid': os.getpid(), 'thread': threading.current_thread().name}
+    if error:
+        rec['error'] = True
+    with recordsLock:
+        records.append(rec)
+
+def wrap(fn):
+    '''Wraps fn submitted to a thread pool so its spans nest in the span open at submit time'''
+    if not settings['enabled']:
+        return fn
+    parent = current()
+
+    @wraps(fn)
+    def wrapped(*args, **kwargs):
+        s = stack()
+        if parent is not None:
+            s.append(parent)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if parent is not None and s and s[-1] is parent:
+                s.pop()
+    return wrapped
+
+def timed(name=None):
+    '''Decorator running the function in a span named after it'''
+    def decorator(fn):
+        @wraps(fn)
+        def wrapped(*args, **kwargs):
+            with span(name or fn.__name__):
+                return fn(*args, **kwargs)
+        return wrapped
+    return decorator
+
+def enable(path, fmt='jsonl'):
+    if fmt not in ('jsonl', 'prom'):
+        raise Exception('Unknown metrics format {}'.format(fmt))
+    settings['enabled'] = True
+    settings['path'] = path
+    settings['fmt'] = fmt
+    with recordsLock:
+        totals.clear()
+
+def disable():
+    settings['enabled'] = False
+
+def export():
+    '''Writes the recorded spans to the metrics file. json lines are appended,
+    the prometheus textfile is replaced with the totals per span path since enable().
+    The exported records are dropped.'''
+    if settings['path'] is None:
+        return
+    with recordsLock:
+        recs = list(records)
+        del records[:]
+    if settings['fmt'] == 'jsonl':
+        if recs:
+            with open(settings['path'], 'a') as f:
+                for rec in recs:
+                    f.write(json.dumps(rec, default=str) + '\n')
+    else:
+        # the textfile holds the totals so the records are added to the running totals
+        with recordsLock:
+            addTotals(recs)
+            current = dict((k, dict(v)) for k, v in totals.items())
+        writePrometheus(settings['path'], current)
+
+def addTotals(recs):
+    for rec in recs:
+        t = totals.setdefault(rec['span'], {'seconds': 0.0, 'calls': 0})
+        t['seconds'] += rec['elapsed']
+        t['calls'] += 1
+        for k, v in rec['counters'].items():
+            t[k] = t.get(k, 0) + v
+
+def writePrometheus(path, totals):
+    lines = list()
+    names = sorted(set(k for t in totals.values() for k in t))
+    for name in names:
+        metric = 'pipeline_span_{}_total'.format(name)
+        lines.append('# TYPE {} counter'.format(metric))
+        for spanPath in sorted(totals):
+            if name in totals[spanPath]:
+                lines.append('{}{{span="{}"}} {}'.format(metric, spanPath, totals[spanPath][name]))
+    with open(path + '.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(path + '.tmp', path)
+
+atexit.register(export)
+
+if os.environ.get('METRICS_FILE'):
+    enable(os.environ['METRICS_FILE'], os.environ.get('METRICS_FORMAT', 'jsonl'))
@@ -11,8 +11,11 @@ Purpose:
 
 import os,sys
 import re
+import json
+import shutil
 import tempfile
 import time
+import queue
 from datetime import timedelta, datetime
 import pandas as pd
 import numpy as np
@@ -20,82 +23,150 @@ import threading
 sys.path.append(os.path.join(os.environ['HOME'], 'python_lib'))
 
 t = time.time()
-from utilities import getDbConnection
+from utilities import getDbConnection, writeDataFrame
+import metrics
 from IBLog import IBLog
 
 scriptName = os.path.splitext(os.path.basename(__file__))[0]
 logger = IBLog("{}.log".format(scriptName))
 logger.init("Start {}.py...".format(scriptName))
 
-dbtypes = {'mysql': {'DATE': 'DATE', 'DATETIME': 'DATETIME', 'INT': 'INT', 'FLOAT': 'FLOAT', 'VARCHAR': 'VARCHAR'},
-           'oracle': {'DATE': 'DATE', 'DATETIME': 'DATE', 'INT': 'NUMBER', 'FLOAT': 'NUMBER', 'VARCHAR': 'VARCHAR2'}
+dbtypes = {'mysql': {'DATE': 'DATE', 'DATETIME': 'DATETIME', 'TINYINT': 'TINYINT', 'SMALLINT': 'SMALLINT', 'INT': 'INT', 'BIGINT': 'BIGINT',
+                     'FLOAT': 'FLOAT', 'DOUBLE': 'DOUBLE', 'VARCHAR': 'VARCHAR', 'TEXT': 'TEXT'},
+           'oracle': {'DATE': 'DATE', 'DATETIME': 'DATE', 'TINYINT': 'NUMBER(3)', 'SMALLINT': 'NUMBER(5)', 'INT': 'NUMBER(10)', 'BIGINT': 'NUMBER(19)',
+                      'FLOAT': 'NUMBER', 'DOUBLE': 'NUMBER', 'VARCHAR': 'VARCHAR2', 'TEXT': 'VARCHAR2(4000)'},
+           'sqlite': {'DATE': 'DATE', 'DATETIME': 'TIMESTAMP', 'TINYINT': 'INTEGER', 'SMALLINT': 'INTEGER', 'INT': 'INTEGER', 'BIGINT': 'INTEGER',
+                      'FLOAT': 'REAL', 'DOUBLE': 'REAL', 'VARCHAR': 'TEXT', 'TEXT': 'TEXT'}
            }
+# (type, max value) of the integer types from the smallest
+int_types = [('TINYINT', 127), ('SMALLINT', 32767), ('INT', 2147483647), ('BIGINT', 9223372036854775807)]
+
+# get_schema settings: rows sampled for the VARCHAR sizes and the type detection (None: all rows)
+# and json file the inferred create statements are kept in across runs (None: only in memory)
+SCHEMA_SAMPLE_ROWS = None
+SCHEMA_CACHE_FILE = None
+# create statements by flavor|table name|columns
+schema_cache = {}
 
 def main():
     
 
     
     inputFile = '/home/users/mhristov/tmp/acct_sync_pos.ib.dat'
-    
-    df = pd.read_csv(inputFile, sep='|')
-    df['dt'] = datetime.now()
-    df.info()
-    df.rename(columns=lambda x: re.sub('^#', '', x), inplace=True)
+    # parse the file in chunks and load them while the next ones are parsed
+    pipeline = True
+    dt = datetime.now()
 
     conn = getDbConnection('MYSQLDEV', schema='clams')
 #     conn = getDbConnection('ORAQAIBCUST')
+#     conn = getDbConnection('SQLITE:/home/users/mhristov/tmp/acct_sync_pos.db')
     
-    write_frame(df, 'test', conn, 'mysql', if_exists='append')
+    if pipeline:
+        load_pipeline(inputFile, 'test', conn, 'mysql', db_alias='MYSQLDEV', db_schema='clams', transform=lambda df: prepare_frame(df, dt),
+                      if_exists='append')
+    else:
+        df = prepare_frame(pd.read_csv(inputFile, sep='|'), dt)
+        df.info()
+        write_frame(df, 'test', conn, 'mysql', if_exists='append')
+#     write_frame(df, 'test', conn, 'oracle', if_exists='append', db_alias='ORAQAIBCUST')
     
     
     s = time.time() - t
     print('Time taken: {}'.format(timedelta(seconds=s)))
     conn.close()
     
-def get_schema(frame, name, flavor):
+def prepare_frame(df, dt):
+    df['dt'] = dt
+    df.rename(columns=lambda x: re.sub('^#', '', x), inplace=True)
+    return df
+
+def get_schema(frame, name, flavor, sample=None, cache_file=None, widen=False):
+    '''
+    Returns the create table statement for a dataframe.
+    The types are inferred column by column:
+        integers and booleans: the smallest integer type fitting twice the largest absolute value
+        floats: FLOAT for float32, DOUBLE for float64
+        datetime64 columns and object columns of datetimes/dates: DATETIME/DATE
+        everything else: VARCHAR twice the longest value (max 4000)
+    sample: number of rows the object columns are inferred from (default SCHEMA_SAMPLE_ROWS). A column is
+        inferred from all rows if its sample has only nulls or mixed types, or its longest sampled value is
+        over 1000. Rare long values outside the sample can be longer than the VARCHAR.
+    widen: the types don't depend on the values, for a table created from a part of the data:
+        integers BIGINT, floats DOUBLE, strings TEXT (VARCHAR2(4000) in oracle)
+    The statement is cached by table name and columns, in cache_file too (default SCHEMA_CACHE_FILE),
+    so the daily loads of the same table skip the inference.
+    '''
+    sample = SCHEMA_SAMPLE_ROWS if sample is None else sample
+    cache_file = SCHEMA_CACHE_FILE if cache_file is None else cache_file
+    key = '{}{}|{}|{}'.format(flavor, '(widen)' if widen else '', name, ','.join(map(str, frame.columns)))
+    if cache_file is not None and key not in schema_cache and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            schema_cache.update(json.load(f))
+    if key in schema_cache:
+        print('Schema of {} from cache'.format(name))
+        return schema_cache[key]
+
     types = dbtypes[flavor]
-#     print(types)
     column_types = []
-    
-    dtypes = frame.dtypes
-#     print(dtypes)
-    
-    for i,k in enumerate(dtypes.index):
-        dt = dtypes[k]
-#         print(i, k, dt, dt.type)
-#         print(str(dt.type))
-        if str(type(dt.type)) == '<class numpy.datetime64>':
-            sqltype = types['DATETIME']
-        elif issubclass(dt.type, np.datetime64):
-            sqltype = types['DATETIME']
-        elif issubclass(dt.type, (np.integer, np.bool)):
-            sqltype = types['INT']
-        elif issubclass(dt.type, np.floating):
-            sqltype = types['FLOAT']
-        else:
-            sampl = frame[frame.columns[i]][0]
-#             print('sample', sampl)
-            if str(type(sampl)) == '<class datetime.datetime>':
-                sqltype = types['DATETIME']
-            elif str(type(sampl)) == '<class datetime.date>':
-                sqltype = types['DATE']
-            else:
-                if flavor in ('mysql', 'oracle'):
-                    size = 2 + max(len(str(a)) for a in frame[k])
-                    size *= 2
-                    if size > 4000:
-                        size = 4000
-#                     print(k, 'varchar size', size)
-                    sqltype = types['VARCHAR'] + '({})'.format(size)
-                else:
-                    sqltype = types['VARCHAR']
+    sampled = None
+    if sample is not None and len(frame) > sample:
+        sampled = frame.sample(sample, random_state=0)
+    for k in frame.columns:
+        sqltype = get_column_type(frame[k], None if sampled is None else sampled[k], types, flavor, widen)
         column_types.append((k, sqltype))
-#     print(['{0} {1}'.format(*x) for x in column_types])
     columns = ', \n '.join(['{0} {1}'.format(*x) for x in column_types])
     template_create = '''CREATE TABLE {name} ({columns});'''.format(**{'name': name, 'columns': columns})
     print(template_create)
+
+    schema_cache[key] = template_create
+    if cache_file is not None:
+        with open(cache_file + '.tmp', 'w') as f:
+            json.dump(schema_cache, f, indent=1)
+        os.replace(cache_file + '.tmp', cache_file)
     return template_create
 
+def get_column_type(column, sampled, types, flavor, widen=False):
+    '''Returns the sql type of a column. Object columns are inferred from sampled if it's given'''
+    from pandas.api.types import infer_dtype
+    dt = column.dtype
+    if pd.api.types.is_datetime64_any_dtype(dt):
+        return types['DATETIME']
+    if pd.api.types.is_bool_dtype(dt):
+        return types['TINYINT']
+    if pd.api.types.is_integer_dtype(dt):
+        if widen:
+            return types['BIGINT']
+        values = column.dropna()
+        largest = 2 * max(abs(int(values.min())), abs(int(values.max()))) if len(values) > 0 else 0
+        for int_type, max_value in int_types:
+            if largest <= max_value:
+                return types[int_type]
+        return types['BIGINT']
+    if pd.api.types.is_float_dtype(dt):
+        return types['FLOAT'] if dt == np.float32 and not widen else types['DOUBLE']
+
+    if sampled is None:
+        sampled = column
+    inferred = infer_dtype(sampled, skipna=True)
+    if sampled is not column and inferred in ('empty', 'mixed'):
+        sampled = column
+        inferred = infer_dtype(column, skipna=True)
+    if inferred == 'datetime':
+        return types['DATETIME']
+    if inferred == 'date':
+        return types['DATE']
+    if widen:
+        return types['TEXT']
+    if flavor not in ('mysql', 'oracle'):
+        return types['VARCHAR']
+    longest = sampled.astype(str).str.len().max() if len(sampled) > 0 else 0
+    if sampled is not column and longest > 1000:
+        longest = column.astype(str).str.len().max()
+    size = 2 * (2 + int(longest))
+    if size > 4000:
+        size = 4000
+    return types['VARCHAR'] + '({})'.format(size)
+
 def table_exists(name=None, con=None, flavor='oracle'):
     if flavor == 'sqlite':
         sql = "SELECT name FROM sqlite_master WHERE type='table' AND name = '{}';".format(name)
@@ -111,16 +182,21 @@ def table_exists(name=None, con=None, flavor='oracle'):
     exists = True if len(df) > 0 else False
     return exists
 
+def split_frame(frame, n=4):
+    bounds = [len(frame) * i // n for i in range(n + 1)]
+    return [frame.iloc[bounds[i]:bounds[i + 1]] for i in range(n)]
+
 def split_into_files(frame):
     files = []
-    dfs = np.array_split(frame, 4)
+    dfs = split_frame(frame, 4)
     for df in dfs:
         tempFile = tempfile.NamedTemporaryFile()
         df.to_csv(tempFile.name, index=False)
         files.append(tempFile)
     return files
 
-def write_frame(frame, name=None, con=None, flavor='oracle', if_exists='fail'):
+@metrics.timed()
+def write_frame(frame, name=None, con=None, flavor='oracle', if_exists='fail', streaming=False, db_alias=None, direct=False, db_schema=None):
     '''
     Write a dataframe stored in a temp file to dbms
     
@@ -129,10 +205,63 @@ def write_frame(frame, name=None, con=None, flavor='oracle', if_exists='fail'):
         'replace': if table with name exists it will be deleted
         'append': assume table with correct schema exists and add data. If no table or bad data then fail
     If table doesn't exists it will be created
+    streaming (mysql): the 4 parts of the frame are written as csv into named pipes read by LOAD DATA
+        while they are written, instead of into temp files loaded afterwards. Nothing is written to disk.
+    db_alias (oracle): alias of con. The 4 parts of the frame are inserted with array binds in parallel
+        sessions to it, each reporting its throughput. Without it the frame is inserted on con.
+    db_alias, db_schema (mysql): alias and schema of con the parts are loaded on, MYSQLDEV and clams by default.
+    direct (oracle): insert the whole frame on con with a direct path (APPEND_VALUES) insert. It locks
+        the table so it is not done in parallel.
     '''
 
     print('dbstuff')
     print(con)
+    create_table(frame, name, con, flavor, if_exists)
+    if flavor == 'mysql' and db_alias is None:
+        db_alias, db_schema = 'MYSQLDEV', 'clams'
+    
+    print(datetime.now())
+    
+    if flavor == 'sqlite':
+        print('Start loading data...')
+        load_sqlite(frame, name, con)
+    elif flavor == 'oracle':
+        print('Start loading data...')
+        load_oracle(frame, name, con, db_alias, direct)
+    elif flavor == 'mysql' and streaming:
+        print('Start streaming data...')
+        errors = dict()
+        thread_list = []
+        for i, part in enumerate(split_frame(frame, 4)):
+            t = threading.Thread(target=metrics.wrap(load_stream), args=(part, name, flavor, i, errors, db_alias, db_schema))
+            thread_list.append(t)
+
+        for thread in thread_list:
+            thread.start()
+
+        for thread in thread_list:
+            thread.join()
+        if errors:
+            raise Exception('Loading part(s) {} of {} failed: {}'.format(sorted(errors), name, [str(errors[i]) for i in sorted(errors)]))
+    elif flavor == 'mysql':
+        tempFiles = split_into_files(frame)
+        print('Start loading data...')
+        thread_list = []
+        for tempFile in tempFiles:
+            t = threading.Thread(target=metrics.wrap(load_data), args=(tempFile, name, flavor, db_alias, db_schema))
+            thread_list.append(t)
+        
+        for thread in thread_list:
+            thread.start()
+        
+        for thread in thread_list:
+            thread.join()
+
+    print(datetime.now(), 'Done')
+
+def create_table(frame, name, con, flavor, if_exists, schema=None, widen=False):
+    '''Drop and/or create the table of frame as needed for if_exists (see write_frame).
+    The table is created with the schema create statement if it's given, else with get_schema(widen=widen).'''
     if if_exists=='replace' and table_exists(name, con, flavor):
         cur = con.cursor()
         cur.execute("drop table {}".format(name))
@@ -142,44 +271,282 @@ def write_frame(frame, name=None, con=None, flavor='oracle', if_exists='fail'):
     if if_exists in ('fail', 'replace') or (if_exists == 'append' and table_exists(name, con, flavor) == False):
         #create table
         print(table_exists(name, con, flavor))
-        schema = get_schema(frame, name, flavor)
+        if schema is None:
+            schema = get_schema(frame, name, flavor, widen=widen)
         if flavor == 'oracle':
             schema = schema.replace(';', '')
         
         cur.execute(schema)
         print('Table {} created.'.format(name))
-    
-    tempFiles = split_into_files(frame)
-    print(datetime.now())
-    
+    cur.close()
+
+def load_pipeline(input_file, name, con, flavor, db_alias=None, transform=None, if_exists='append', chunksize=200000, workers=4,
+                  queue_size=8, schema=None, db_schema=None, **read_kwargs):
+    '''
+    Load a pipe delimited file into a table while it's parsed.
+    A producer parses the file in chunks of chunksize rows (transform is applied to every chunk) and puts them
+    in a queue of queue_size chunks, which the workers loader threads take and load as they arrive.
+    The producer waits while the queue is full so at most queue_size + workers chunks are in memory.
+    If the table doesn't exist (or if_exists is 'replace') it's created with the schema create statement, or
+    if it's not given from the first chunk with widened types (see get_schema), since the other chunks aren't
+    parsed yet. Integer columns with empty fields in a later chunk are loaded as nulls. A chunk with a column
+    whose type doesn't fit the type of the first chunk (ex. fractions or strings in an integer column) stops the
+    load with an error instead of being truncated; pass schema for such files.
+    Every chunk is committed when it's loaded, so the error of a failed load names the parts already committed.
+    Loaders:
+        mysql: every chunk is streamed to LOAD DATA through a named pipe on a pooled connection to db_alias and
+            db_schema, the alias and schema of con (needed)
+        oracle: every chunk is inserted with array binds on a pooled connection to db_alias, on con with one worker without it
+        sqlite: the chunks are inserted on con by one worker
+    A summary of the rows and the busy/waiting time of every stage is printed and returned.
+    '''
+    if flavor not in ('mysql', 'oracle', 'sqlite'):
+        raise NotImplementedError
+    if flavor == 'mysql' and db_alias is None:
+        raise Exception('db_alias and db_schema of con are needed for the mysql loads')
+    if flavor == 'sqlite' or (flavor == 'oracle' and db_alias is None):
+        # one connection, loads can't run in parallel
+        workers = 1
+    read_kwargs.setdefault('sep', '|')
+    chunks = queue.Queue(maxsize=queue_size)
+    errors = dict()
+    # part -> rows of the chunks loaded and committed
+    committed = dict()
+    stats = {'parse': {'rows': 0, 'chunks': 0, 'busy': 0.0, 'wait': 0.0}}
+    for i in range(workers):
+        stats['load{}'.format(i)] = {'rows': 0, 'chunks': 0, 'busy': 0.0, 'wait': 0.0}
+    ts = time.time()
+
+    reader = pd.read_csv(input_file, chunksize=chunksize, **read_kwargs)
+    first = next(reader, None)
+    if first is None:
+        print('Nothing to load from {}'.format(input_file))
+        return stats
+    if transform is not None:
+        first = transform(first)
+    stats['parse']['busy'] += time.time() - ts
+    create_table(first, name, con, flavor, if_exists, schema=schema, widen=True)
+    kinds = dict((c, first[c].dtype.kind) for c in first.columns)
+
+    def produce():
+        chunk = first
+        part = 0
+        try:
+            while chunk is not None and not errors:
+                stats['parse']['rows'] += len(chunk)
+                stats['parse']['chunks'] += 1
+                tw = time.time()
+                chunks.put((part, chunk))
+                stats['parse']['wait'] += time.time() - tw
+                part += 1
+                tp = time.time()
+                with metrics.span('parse_chunk', part=part):
+                    chunk = next(reader, None)
+                    if chunk is not None and transform is not None:
+                        chunk = transform(chunk)
+                    if chunk is not None and schema is None:
+                        chunk = check_chunk_types(chunk, kinds, part)
+                stats['parse']['busy'] += time.time() - tp
+        except Exception as e:
+            print('Parsing {} failed: {}'.format(input_file, e))
+            errors['parse'] = e
+        finally:
+            for i in range(workers):
+                chunks.put(None)
+
+    def load(worker):
+        stage = stats['load{}'.format(worker)]
+        while True:
+            tw = time.time()
+            item = chunks.get()
+            stage['wait'] += time.time() - tw
+            if item is None:
+                break
+            part, chunk = item
+            if errors:
+                # keep taking the chunks so the producer doesn't block
+                continue
+            tl = time.time()
+            load_chunk(chunk, name, con, flavor, db_alias, part, errors, db_schema)
+            if part not in errors:
+                committed[part] = len(chunk)
+            stage['busy'] += time.time() - tl
+            stage['rows'] += len(chunk)
+            stage['chunks'] += 1
+
+    threads = [threading.Thread(target=metrics.wrap(produce))]
+    threads += [threading.Thread(target=metrics.wrap(load), args=(i,)) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - ts
+
+    print('{:<8} {:>12} {:>8} {:>10} {:>10}'.format('stage', 'rows', 'chunks', 'busy(s)', 'wait(s)'))
+    for stage, st in stats.items():
+        print('{:<8} {:>12} {:>8} {:>10.1f} {:>10.1f}'.format(stage, st['rows'], st['chunks'], st['busy'], st['wait']))
+    print('Loaded {} rows into {} in {}'.format(sum(st['rows'] for k, st in stats.items() if k != 'parse'), name, timedelta(seconds=elapsed)))
+    stats['elapsed'] = elapsed
+    if errors:
+        raise Exception('Loading {} into {} failed, partially loaded: part(s) {} ({} rows) are committed: {}'.format(
+            input_file, name, sorted(committed), sum(committed.values()), dict((k, str(e)) for k, e in errors.items())))
+    return stats
+
+# dtype kinds of the first chunk -> kinds of the later chunks its widened column type can hold
+compatible_kinds = {'b': 'b', 'i': 'biu', 'u': 'biu', 'f': 'biuf', 'M': 'M'}
+
+def check_chunk_types(chunk, kinds, part):
+    '''Raise if a column of a chunk can't be loaded in the column created from the first chunk.
+    Returns the chunk with the integer columns read as floats because of empty fields converted to nullable Int64.'''
+    for c in chunk.columns:
+        kind = chunk[c].dtype.kind
+        first_kind = kinds.get(c)
+        if first_kind in 'iu' and kind == 'f':
+            values = chunk[c].dropna()
+            if (values == values.round()).all():
+                chunk[c] = chunk[c].astype('Int64')
+                continue
+        if first_kind in compatible_kinds and kind not in compatible_kinds[first_kind]:
+            raise Exception('Column {} of part {} is {} but {} in the first part, pass schema to load_pipeline'.format(
+                c, part, chunk[c].dtype, first_kind))
+    return chunk
+
+def load_chunk(chunk, name, con, flavor, db_alias, part, errors, db_schema=None):
+    '''Load one chunk of load_pipeline. Errors are put in errors[part]'''
     if flavor == 'mysql':
-        print('Start loading data...')
-        thread_list = []
-        for tempFile in tempFiles:
-            t = threading.Thread(target=load_data, args=(tempFile, name, flavor))
-            thread_list.append(t)
-        
-        for thread in thread_list:
-            thread.start()
-        
-        for thread in thread_list:
-            thread.join()
+        load_stream(chunk, name, flavor, part, errors, db_alias, db_schema)
+        return
+    try:
+        with metrics.span('load_chunk', part=part):
+            if flavor == 'sqlite':
+                load_sqlite(chunk, name, con)
+            elif db_alias is None:
+                writeDataFrame(con, name, chunk)
+            else:
+                db = getDbConnection(db_alias, pooled=True)
+                try:
+                    writeDataFrame(db, name, chunk)
+                finally:
+                    db.close()
+    except Exception as e:
+        print('Loading part {} of {} failed: {}'.format(part, name, e))
+        errors[part] = e
 
-    print(datetime.now(), 'Done')
+def load_sqlite(frame, tableName, con, batch_size=100000):
+    '''
+    Bulk load a dataframe into a sqlite table with executemany in a single transaction.
+    The journal is switched to WAL and synchronous to OFF for the load, so a crash of the
+    machine during the load can corrupt the database (not a crash of the process).
+    '''
+    cur = con.cursor()
+    synchronous = cur.execute('PRAGMA synchronous').fetchone()[0]
+    cur.execute('PRAGMA journal_mode=WAL')
+    cur.execute('PRAGMA synchronous=OFF')
+    try:
+        with metrics.span('load_sqlite', table=tableName):
+            writeDataFrame(con, tableName, frame, batchSize=batch_size)
+    finally:
+        cur.execute('PRAGMA synchronous={}'.format(synchronous))
+        cur.close()
 
-def load_data(tempFile, tableName, flavor):
-    db = getDbConnection('MYSQLDEV', schema='clams')
-    cur = db.cursor()
-    loadSql = '''LOAD DATA LOCAL INFILE '{}' INTO TABLE {}
+def get_load_sql(fileName, tableName):
+    return '''LOAD DATA LOCAL INFILE '{}' INTO TABLE {}
                     FIELDS TERMINATED BY ','
                     OPTIONALLY ENCLOSED BY '"'
                     LINES TERMINATED BY '\n'
-                    IGNORE 1 LINES'''.format(tempFile.name, tableName)
-    print(loadSql)
-    cur.execute(loadSql)
-    db.commit()
-    db.close()
-    tempFile.close()  
+                    IGNORE 1 LINES'''.format(fileName, tableName)
+
+def write_fifo(frame, fifo, errors):
+    '''Write a dataframe as csv into a named pipe. Blocks until the pipe is opened for reading.
+    The nulls are written as \\N so LOAD DATA loads them as NULL.'''
+    try:
+        with open(fifo, 'w', newline='') as f:
+            frame.to_csv(f, index=False, na_rep='\\N')
+    except Exception as e:
+        # BrokenPipeError if the reader stops reading
+        errors['writer'] = e
+
+def drain_fifo(fifo, writer):
+    '''Read a named pipe until its writer thread ends, so a writer no loader reads from doesn't block forever'''
+    fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        while True:
+            try:
+                data = os.read(fd, 1 << 20)
+            except BlockingIOError:
+                data = None
+            if not data:
+                if not writer.is_alive():
+                    break
+                writer.join(0.05)
+    finally:
+        os.close(fd)
+
+def load_stream(frame, tableName, flavor, part, errors, db_alias, db_schema=None):
+    '''
+    Load a dataframe with LOAD DATA reading the csv from a named pipe while a writer thread fills it.
+    The load runs on a pooled connection to db_alias and db_schema.
+    The load is committed only if the whole frame was written. Errors are put in errors[part].
+    '''
+    fifoDir = tempfile.mkdtemp()
+    fifo = os.path.join(fifoDir, '{}.{}.csv'.format(tableName, part))
+    os.mkfifo(fifo)
+    writerErrors = dict()
+    writer = threading.Thread(target=write_fifo, args=(frame, fifo, writerErrors))
+    writer.start()
+    db = None
+    try:
+        db = getDbConnection(db_alias, schema=db_schema, pooled=True)
+        cur = db.cursor()
+        loadSql = get_load_sql(fifo, tableName)
+        print(loadSql)
+        with metrics.span('load_stream', part=part) as s:
+            cur.execute(loadSql)
+            writer.join()
+            if writerErrors:
+                raise Exception('Writing part {} failed: {}'.format(part, writerErrors['writer']))
+            db.commit()
+            s.add(rows=cur.rowcount, roundTrips=1)
+    except Exception as e:
+        print('Loading part {} of {} failed: {}'.format(part, tableName, e))
+        errors[part] = e
+        if db is not None:
+            db.rollback()
+    finally:
+        if writer.is_alive():
+            drain_fifo(fifo, writer)
+        writer.join()
+        if db is not None:
+            db.close()
+        shutil.rmtree(fifoDir, ignore_errors=True)
+
+def load_oracle(frame, tableName, con, db_alias=None, direct=False, parallel=4):
+    '''
+    Insert a dataframe into an oracle table with array bound inserts (utilities.writeDataFrame).
+    With db_alias the parts are inserted in parallel sessions and every part is committed on its own.
+    '''
+    with metrics.span('load_oracle', table=tableName):
+        if direct:
+            writeDataFrame(con, tableName, frame, hint='APPEND_VALUES')
+        elif db_alias is not None:
+            writeDataFrame(con, tableName, frame, parallel=parallel, dbAlias=db_alias)
+        else:
+            writeDataFrame(con, tableName, frame)
+
+def load_data(tempFile, tableName, flavor, db_alias, db_schema=None):
+    db = getDbConnection(db_alias, schema=db_schema, pooled=True)
+    try:
+        cur = db.cursor()
+        loadSql = get_load_sql(tempFile.name, tableName)
+        print(loadSql)
+        with metrics.span('load_data', file=os.path.basename(tempFile.name)) as s:
+            cur.execute(loadSql)
+            db.commit()
+            s.add(rows=cur.rowcount, bytes=os.path.getsize(tempFile.name), roundTrips=1)
+    finally:
+        # the connection goes back to the pool even if the load fails
+        db.close()
+        tempFile.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
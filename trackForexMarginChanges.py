@@ -14,7 +14,7 @@ import shutil
 import sqlalchemy as sa
 sys.path.append(os.path.join(os.environ['HOME'], 'python_lib'))
 
-from utilities import getDbConnection
+from utilities import getDbConnection, getTableObj
 from IBLog import IBLog #@UnresolvedImport
 from IBMail import IBMail
 
@@ -114,8 +114,7 @@ def mergeOldAndNew(dfAllOld, dfAllNew, dt):
 
 def updateTable(engine, tableName, df):
     conn = engine.connect()
-    metadata = sa.MetaData(bind=engine)
-    forexMarginChanges = sa.Table(tableName, metadata, autoload=True)
+    forexMarginChanges = getTableObj(sa, engine, tableName)
     trans = conn.begin()
     try:
         #Changed margin value: update on value and date needed
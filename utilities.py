@@ -5,14 +5,16 @@ Created on 7 Nov 2014
 '''
 import os
 import re
+import threading
 import cx_Oracle
-from time import time
+from time import time, sleep
 from functools import wraps
 from datetime import datetime, timedelta
 from collections import defaultdict
 from itertools import islice
 from pandas import Series
 import pyprind
+import metrics
 
 def autodict(): return defaultdict(autodict)
 
@@ -27,7 +29,8 @@ def timeit(method):
     @wraps(method) #using wraps to be able to preserve the docstring of the method
     def timed(*args, **kwargs):
         ts = time()
-        result = method(*args, **kwargs)
+        with metrics.span(method.__name__):
+            result = method(*args, **kwargs)
         te = time()
         m, s = divmod(te - ts, 60)
         h, m = divmod(m, 60)
@@ -36,13 +39,31 @@ def timeit(method):
         return result
     return timed
 
+# lines of ~/config/.dbaccess.config, read again when the mtime of the file changes
+dbAccessConfig = {'mtime': None, 'lines': None}
+dbLock = threading.Lock()
+
+def readDbAccessConfig():
+    config_file=os.environ['HOME']+"/config/.dbaccess.config"
+    mtime = os.stat(config_file).st_mtime_ns
+    with dbLock:
+        if dbAccessConfig['mtime'] != mtime:
+            with open(config_file) as file:
+                dbAccessConfig['lines'] = file.readlines()
+            dbAccessConfig['mtime'] = mtime
+        return dbAccessConfig['lines']
+
 def getDbCredentials(dbalias, asEngineStr=False):
     '''Function to get database credentials from a config file ~/config/.dbaccess.config for a database alias
-    If asEngineStr is true returns sqlalchemy engine connection string'''
+    If asEngineStr is true returns sqlalchemy engine connection string
+    The file is parsed once and again only when it changes
+    SQLite databases are either SQLITE:<path> aliases, which are not looked up in the file,
+    or lines like SQLITECACHE|/home/mhristov/data/cache.db|||. The path of the database file is returned.'''
+    if dbalias.upper().startswith('SQLITE:'):
+        path = dbalias[len('SQLITE:'):]
+        return 'sqlite:///{}'.format(path) if asEngineStr else path
     dbalias=dbalias.upper()
-    config_file=os.environ['HOME']+"/config/.dbaccess.config"
-    file = open(config_file)
-    lines = file.readlines()
+    lines = readDbAccessConfig()
     data = []
     mysqlConfig = dict()
     for line in lines:
@@ -51,6 +72,9 @@ def getDbCredentials(dbalias, asEngineStr=False):
         if m is None:
             continue 
         data = line.strip().split('|')
+        if dbalias.startswith('SQLITE'):
+            path = data[1]
+            continue
         schema = data[1].upper()
         port = data[2]
         user = data[3]
@@ -71,18 +95,89 @@ def getDbCredentials(dbalias, asEngineStr=False):
                 return 'mysql+mysqlconnector://{0}:{1}@{2}:{3}'.format(mysqlConfig['user'], mysqlConfig['password'], mysqlConfig['host'], mysqlConfig['port'])
             else:
                 return mysqlConfig
+        elif dbalias.startswith('SQLITE'):
+            return 'sqlite:///{}'.format(path) if asEngineStr else path
     else:
         return "X"
 
-def getDbConnection(dbAlias, schema=None, asEngine=False, echo=False):
+# connection pools: (dbAlias, schema) -> cx_Oracle.SessionPool/MySQLConnectionPool
+dbPools = dict()
+# locks held while a pool is created: (dbAlias, schema) -> threading.Lock
+dbPoolLocks = dict()
+# sqlalchemy engines: (connection string, echo) -> engine
+dbEngines = dict()
+# max connections of a pool
+POOL_SIZE = 8
+# seconds between the tries to borrow a connection from an exhausted mysql pool
+POOL_WAIT = 0.05
+# seconds to wait for a connection of an exhausted pool before raising
+POOL_TIMEOUT = 300
+
+def getDbPool(dbAlias, schema=None):
+    '''Returns the connection pool of dbAlias (and schema for mysql). It is created on the first call'''
+    key = (dbAlias.upper(), schema)
+    with dbLock:
+        if key in dbPools:
+            return dbPools[key]
+        keyLock = dbPoolLocks.setdefault(key, threading.Lock())
+    # only one thread creates the pool of a key, the others wait for it
+    with keyLock:
+        if key in dbPools:
+            return dbPools[key]
+        dbCredentials = getDbCredentials(dbAlias)
+        if dbCredentials == 'X':
+            print('Error: dbAlias {} not valid!'.format(dbAlias))
+            return None
+        if dbAlias.upper().startswith('ORA'):
+            userPasswd, _, dsn = dbCredentials.rpartition('@')
+            user, _, passwd = userPasswd.partition('/')
+            pool = cx_Oracle.SessionPool(user, passwd, dsn, min=1, max=POOL_SIZE, increment=1, threaded=True,
+                                         getmode=cx_Oracle.SPOOL_ATTRVAL_TIMEDWAIT, waitTimeout=POOL_TIMEOUT * 1000)
+        elif dbAlias.upper().startswith('MYSQL'):
+            from mysql.connector.pooling import MySQLConnectionPool
+            pool = MySQLConnectionPool(pool_name='{}_{}'.format(dbAlias, schema), pool_size=POOL_SIZE, database=schema, **dbCredentials)
+        else:
+            raise NotImplementedError('No pool for dbAlias {}'.format(dbAlias))
+        with dbLock:
+            dbPools[key] = pool
+        return pool
+
+def borrowConnection(dbAlias, schema=None):
+    '''Returns a connection from the pool of dbAlias. conn.close() returns it to the pool.
+    When all POOL_SIZE connections are borrowed it waits for one to be returned (mysql and oracle)
+    and raises if none is returned in POOL_TIMEOUT seconds.'''
+    pool = getDbPool(dbAlias, schema)
+    if pool is None:
+        return None
+    if dbAlias.upper().startswith('ORA'):
+        return pool.acquire()
+    # MySQLConnectionPool raises PoolError when it's exhausted, unlike the oracle pool in wait mode
+    from mysql.connector.errors import PoolError
+    deadline = time() + POOL_TIMEOUT
+    while True:
+        try:
+            return pool.get_connection()
+        except PoolError:
+            if time() > deadline:
+                raise Exception('No connection of the {} pool returned in {}s, all {} are borrowed'.format(dbAlias, POOL_TIMEOUT, POOL_SIZE))
+            sleep(POOL_WAIT)
+
+def getDbConnection(dbAlias, schema=None, asEngine=False, echo=False, pooled=False):
     '''Returns connection object based on dbAlias.
     Schema argument is only applicable for mysql connections.
-    If asEngine argument is set to True returns sqlalchemy engine.
+    If asEngine argument is set to True returns sqlalchemy engine. One engine is created per connection string.
     If echo is set to True makes the engine in echo mode    
+    If pooled is set to True the connection is borrowed from the pool of dbAlias and schema (see getDbPool).
+    conn.close() returns it to the pool. SQLite connections are not pooled.
+    SQLite connections (SQLITE:<path> or SQLITE aliases) are in WAL journal mode so readers don't block the loads.
     
     Usage: conn = getDbConnection('ORADEV')
+           conn = getDbConnection('SQLITE:/home/mhristov/tmp/cache.db')
     
     '''
+    isSqlite = dbAlias.upper().startswith('SQLITE')
+    if pooled and not asEngine and not isSqlite:
+        return borrowConnection(dbAlias, schema)
     conn = None
     dbCredentials = getDbCredentials(dbAlias)
     engineEcho = False
@@ -95,7 +190,7 @@ def getDbConnection(dbAlias, schema=None, asEngine=False, echo=False):
         if dbAlias.startswith('ORA'):
             if asEngine:
                 connStr = 'oracle://{}'.format(dbCredentials.replace('/',':'))
-                conn = create_engine(connStr, echo=engineEcho)
+                conn = getEngine(create_engine, connStr, engineEcho)
             else:
                 conn = cx_Oracle.connect(dbCredentials)
         elif dbAlias.startswith('MYSQL'):
@@ -104,56 +199,618 @@ def getDbConnection(dbAlias, schema=None, asEngine=False, echo=False):
                 dbCredentials['schema'] = schema
                 dbCredentials['allow_local_infile'] = True
                 connStr = 'mysql+mysqlconnector://{user}:{password}@{host}:{port}/{schema}'.format(**dbCredentials)
-                conn = create_engine(connStr, echo=engineEcho)
+                conn = getEngine(create_engine, connStr, engineEcho)
             else:
                 conn = mysql.connector.connect(database=schema,**dbCredentials)
+        elif isSqlite:
+            if asEngine:
+                conn = getEngine(create_engine, 'sqlite:///{}'.format(dbCredentials), engineEcho)
+            else:
+                import sqlite3
+                conn = sqlite3.connect(dbCredentials, timeout=60, check_same_thread=False)
+                conn.execute('PRAGMA journal_mode=WAL')
     else: print('Error: dbAlias {} not valid!'.format(dbAlias))
     return conn
 
+def getEngine(create_engine, connStr, echo):
+    with dbLock:
+        if (connStr, echo) not in dbEngines:
+            dbEngines[(connStr, echo)] = create_engine(connStr, echo=echo)
+        return dbEngines[(connStr, echo)]
+
+# process wide cache of reflected sqlalchemy tables: (engine url, schema, table name) -> (Table, reflection time)
+reflectedTables = dict()
+# one MetaData per engine url holding the reflected tables
+reflectionMetadata = dict()
+reflectionLock = threading.Lock()
+# seconds after which a cached table is reflected again. None means never
+REFLECTION_TTL = None
+
+def getTableObj(sa, engine, tableName, schema=None, ttl=None, refresh=False):
+    '''Returns the reflected sqlalchemy Table for tableName. Tables are reflected once per process
+    and engine url and taken from the cache after that.
+    ttl: seconds after which the table is reflected again, REFLECTION_TTL by default
+    refresh: reflect the table even if it's cached
+    
+    Usage: tableObj = getTableObj(sa, engine, 'CUSTOMERACCOUNT_RTAB')
+    '''
+    if ttl is None:
+        ttl = REFLECTION_TTL
+    url = str(engine.url)
+    key = (url, schema, tableName)
+    with reflectionLock:
+        cached = reflectedTables.get(key)
+        if cached is not None and not refresh and (ttl is None or time() - cached[1] < ttl):
+            cached[0].metadata.bind = engine
+            return cached[0]
+        if url not in reflectionMetadata:
+            reflectionMetadata[url] = sa.MetaData(bind=engine)
+        metadata = reflectionMetadata[url]
+        metadata.bind = engine
+        if cached is not None:
+            metadata.remove(cached[0])
+        tableObj = sa.Table(tableName, metadata, schema=schema, autoload=True)
+        reflectedTables[key] = (tableObj, time())
+        return tableObj
+
+def clearReflectionCache():
+    with reflectionLock:
+        reflectedTables.clear()
+        reflectionMetadata.clear()
+
+def saveReflectionCache(path):
+    '''Pickles the reflected tables to path so other processes can load them with loadReflectionCache'''
+    import pickle
+    with reflectionLock:
+        entries = dict((k, (t.key, ts)) for k, (t, ts) in reflectedTables.items())
+        state = {'metadata': reflectionMetadata, 'entries': entries}
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+def loadReflectionCache(engine, path):
+    '''Loads the reflected tables of engine saved by saveReflectionCache. Entries older than REFLECTION_TTL are skipped.'''
+    import pickle
+    if not os.path.exists(path):
+        return
+    url = str(engine.url)
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    if url not in state['metadata']:
+        return
+    with reflectionLock:
+        metadata = state['metadata'][url]
+        metadata.bind = engine
+        reflectionMetadata[url] = metadata
+        for key, (tableKey, ts) in state['entries'].items():
+            if key[0] == url and (REFLECTION_TTL is None or time() - ts < REFLECTION_TTL):
+                reflectedTables[key] = (metadata.tables[tableKey], ts)
+
+def iterResultFrames(res, chunksize=50000, arraysize=None):
+    '''Generator over the rows of a sqlalchemy result as DataFrames of up to chunksize rows.
+    arraysize is the number of rows the dbapi cursor fetches per round trip.'''
+    from pandas import DataFrame
+    if arraysize is not None:
+        res.cursor.arraysize = arraysize
+    columns = res.keys()
+    try:
+        while True:
+            rows = res.fetchmany(chunksize)
+            if not rows:
+                break
+            yield DataFrame.from_records(rows, columns=columns)
+    finally:
+        res.close()
+
+def resultToDataFrame(res, chunksize=50000, arraysize=None):
+    '''Builds a DataFrame from a sqlalchemy result chunksize rows at a time so only one batch of row tuples is held in memory'''
+    from pandas import DataFrame, concat
+    columns = res.keys()
+    dfs = list(iterResultFrames(res, chunksize, arraysize))
+    if len(dfs) == 0:
+        return DataFrame(columns=columns)
+    return concat(dfs, ignore_index=True)
+
 def rowsToDictList(cursor):
     columns = [i[0] for i in cursor.description]
     return [dict(zip(columns,row)) for row in cursor]
 
+TRADESTORE_FILE = '/home/mhristov//IN/trades.data.{0:%Y%m%d}.gz'
+
+class TradestoreCache(object):
+    '''On disk cache of parsed tradestore day files stored in feather format (needs pyarrow).
+    Entries are keyed by the path, size and mtime of the source file so a changed file is parsed again,
+    and by the dtype it was parsed with.
+    The cache is kept under maxSizeMB by evicting the least recently used entries.
+
+    Usage: cache = TradestoreCache('/home/mhristov/tmp/tradestoreCache', maxSizeMB=20480)
+           df = queryTradestoreFiles(pd, '20160101', '20160131', cache=cache)
+    '''
+    def __init__(self, cacheDir, maxSizeMB=10240):
+        self.cacheDir = cacheDir
+        self.maxSize = maxSizeMB * 1024 * 1024
+        os.makedirs(cacheDir, exist_ok=True)
+
+    def entryPath(self, file, dtype=None):
+        import hashlib
+        st = os.stat(file)
+        key = '{}|{}|{}'.format(os.path.abspath(file), st.st_size, st.st_mtime_ns)
+        dtypeKey = repr(sorted(dtype.items(), key=str) if isinstance(dtype, dict) else dtype)
+        return os.path.join(self.cacheDir, '{}.{}.{}.feather'.format(os.path.basename(file), hashlib.sha1(key.encode()).hexdigest(),
+                                                                      hashlib.sha1(dtypeKey.encode()).hexdigest()[:8]))
+
+    def get(self, pd, file, columns=None, dtype=None):
+        '''Returns the cached frame for file parsed with dtype or None on a cache miss'''
+        path = self.entryPath(file, dtype)
+        # another process may evict the entry at any time so a missing file is a cache miss
+        try:
+            # the mtime of an entry is its last access time, used for the LRU eviction
+            os.utime(path)
+            return pd.read_feather(path, columns=columns)
+        except FileNotFoundError:
+            return None
+
+    def put(self, df, file, dtype=None):
+        path = self.entryPath(file, dtype)
+        # remove the entries of older versions of the same file, the ones of the current version with other dtypes are kept
+        prefix = os.path.basename(file) + '.'
+        version = os.path.basename(path).rsplit('.', 2)[0] + '.'
+        for entry in os.listdir(self.cacheDir):
+            if entry.startswith(prefix) and entry.endswith('.feather') and not entry.startswith(version):
+                removeEntry(os.path.join(self.cacheDir, entry))
+        tmpPath = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            df.reset_index(drop=True).to_feather(tmpPath)
+        except Exception as e:
+            print('Warning: {} not cached: {}'.format(file, e))
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            return
+        os.replace(tmpPath, path)
+        self.evict()
+
+    def evict(self):
+        entries = list()
+        for e in os.listdir(self.cacheDir):
+            if not e.endswith('.feather'):
+                continue
+            # entries removed by other processes since listdir are skipped
+            try:
+                st = os.stat(os.path.join(self.cacheDir, e))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, os.path.join(self.cacheDir, e)))
+        entries.sort()
+        total = sum(e[1] for e in entries)
+        for mtime, size, entry in entries:
+            if total <= self.maxSize:
+                break
+            removeEntry(entry)
+            total -= size
+
+def removeEntry(path):
+    '''Removes a cache file which another process may have removed already'''
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# operators for the where predicates of queryTradestoreFiles: (column, op, value)
+PREDICATE_OPERATORS = {
+    '==': lambda s, v: s == v,
+    '!=': lambda s, v: s != v,
+    '<': lambda s, v: s < v,
+    '<=': lambda s, v: s <= v,
+    '>': lambda s, v: s > v,
+    '>=': lambda s, v: s >= v,
+    'in': lambda s, v: s.isin(v),
+    'not in': lambda s, v: ~s.isin(v),
+    'between': lambda s, v: s.between(*v)
+    }
+
+def verifyPredicates(where):
+    for column, op, value in where:
+        if op not in PREDICATE_OPERATORS:
+            raise Exception('Error: operator {} does no exist'.format(op))
+
+def filterChunk(chunk, filter_=None, where=None):
+    '''Applies the where predicates and the filter_ function to a chunk'''
+    if where:
+        mask = None
+        for column, op, value in where:
+            m = PREDICATE_OPERATORS[op](chunk[column], value)
+            mask = m if mask is None else mask & m
+        chunk = chunk[mask]
+    if filter_ is not None:
+        chunk = chunk[filter_(chunk)]
+    return chunk
+
+def getTradestoreUsecols(filter_=None, columns=None, where=None, skipZeroTrades=False, dropDuplicateTrades=False):
+    '''Returns the columns that need to be read from a tradestore file or None if all are needed.
+    filter_ is a function and its columns are unknown so all columns are read when it is given.'''
+    if columns is None or filter_ is not None:
+        return None
+    usecols = list(columns)
+    needed = [c for c, op, v in (where or [])]
+    if skipZeroTrades:
+        needed.append('QUANTITY')
+    if dropDuplicateTrades:
+        needed.append('#EXEC_ID')
+    for c in needed:
+        if c not in usecols:
+            usecols.append(c)
+    return usecols
+
+class TradestoreAccountIndex(object):
+    '''Account index over the tradestore day files.
+    build() writes a re-blocked copy of a day file made of independent gzip members of blockRows lines
+    and an index with the byte offset of every block and the row numbers of every ACCOUNT_ID.
+    queryTradestoreFiles(accountIndex=) uses it when where has an ACCOUNT_ID == or in predicate:
+    only the blocks with these accounts are decompressed and only their rows are parsed.
+
+    Usage: index = TradestoreAccountIndex('/home/mhristov/tmp/tradestoreIndex')
+           index.buildDates(pd, '20160101', '20161231')
+           df = queryTradestoreFiles(pd, '20160101', '20161231', where=[('ACCOUNT_ID', 'in', accts)], accountIndex=index)
+    '''
+    def __init__(self, indexDir, blockRows=20000):
+        self.indexDir = indexDir
+        self.blockRows = blockRows
+        os.makedirs(indexDir, exist_ok=True)
+
+    def paths(self, file):
+        base = os.path.join(self.indexDir, os.path.basename(file))
+        return base + '.blocks.gz', base + '.idx'
+
+    def sourceKey(self, file):
+        st = os.stat(file)
+        return st.st_size, st.st_mtime_ns
+
+    def build(self, file):
+        import gzip
+        import pickle
+        import numpy as np
+        blocksPath, idxPath = self.paths(file)
+        blocks = list()
+        accounts = defaultdict(list)
+        with gzip.open(file, 'rt') as f, open(blocksPath + '.tmp', 'wb') as out:
+            header = f.readline()
+            pos = header.rstrip('\r\n').split('|').index('ACCOUNT_ID')
+            row = 0
+            while True:
+                lines = list(islice(f, self.blockRows))
+                if not lines:
+                    break
+                data = gzip.compress(''.join(lines).encode())
+                for line in lines:
+                    # the line ending is stripped so an ACCOUNT_ID in the last column is indexed without it
+                    accounts[line.rstrip('\r\n').split('|', pos + 1)[pos]].append(row)
+                    row += 1
+                blocks.append((out.tell(), len(data)))
+                out.write(data)
+        idx = {'source': self.sourceKey(file), 'header': header, 'blockRows': self.blockRows, 'blocks': blocks,
+               'accounts': {a: np.array(rows, dtype=np.int64) for a, rows in accounts.items()}}
+        with open(idxPath + '.tmp', 'wb') as f:
+            pickle.dump(idx, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(blocksPath + '.tmp', blocksPath)
+        os.replace(idxPath + '.tmp', idxPath)
+        print('Index built for {}: {} blocks, {} accounts'.format(file, len(blocks), len(accounts)))
+
+    def buildDates(self, pd, startDate, endDate):
+        datelist = pd.date_range(start=pd.to_datetime(startDate, format='%Y%m%d'), end=pd.to_datetime(endDate, format='%Y%m%d'))
+        for dt in datelist.tolist():
+            file = TRADESTORE_FILE.format(dt)
+            if os.path.exists(file) and self.load(file) is None:
+                self.build(file)
+
+    def load(self, file):
+        '''Returns the index of file or None if there is no index or it's older than the file'''
+        import pickle
+        blocksPath, idxPath = self.paths(file)
+        if not os.path.exists(idxPath) or not os.path.exists(blocksPath):
+            return None
+        with open(idxPath, 'rb') as f:
+            idx = pickle.load(f)
+        if idx['source'] != self.sourceKey(file):
+            return None
+        return idx
+
+    def readAccountRows(self, pd, file, accounts, usecols=None, dtype=None):
+        '''Returns a list with a single chunk of the rows of accounts in file or None if file is not indexed.
+        The chunk has the row numbers of the original file as index.'''
+        import gzip
+        import numpy as np
+        from io import StringIO
+        idx = self.load(file)
+        if idx is None:
+            return None
+        rows = [idx['accounts'][str(a)] for a in set(accounts) if str(a) in idx['accounts']]
+        rows = np.unique(np.concatenate(rows)) if rows else np.empty(0, dtype=np.int64)
+        blockNos = rows // idx['blockRows']
+        selected = list()
+        with open(self.paths(file)[0], 'rb') as f:
+            for blockNo in np.unique(blockNos):
+                offset, length = idx['blocks'][blockNo]
+                f.seek(offset)
+                lines = gzip.decompress(f.read(length)).decode().split('\n')
+                selected.extend(lines[r] for r in rows[blockNos == blockNo] - blockNo * idx['blockRows'])
+        print('Read {} rows from {} of {} blocks of the account index'.format(len(rows), len(np.unique(blockNos)), len(idx['blocks'])))
+        selected.append('')
+        chunk = pd.read_csv(StringIO(idx['header'] + '\n'.join(selected)), sep='|', usecols=usecols, dtype=dtype)
+        chunk.index = pd.Index(rows)
+        return [chunk]
+
+def getAccountLookup(where):
+    '''Returns the accounts of an ACCOUNT_ID == or in predicate or None'''
+    for column, op, value in (where or []):
+        if column == 'ACCOUNT_ID' and op == '==':
+            return [value]
+        if column == 'ACCOUNT_ID' and op == 'in':
+            return list(value)
+    return None
+
+def getShortExecIds(execIds):
+    '''Vectorized version of '.'.join(execId.split('.')[:3]) for a series of exec ids'''
+    return execIds.str.split('.', n=3).str[:3].str.join('.')
+
+# days of the dedup index (dedupIndexFile) kept before the first queried day. None means all
+DEDUP_RETENTION_DAYS = 31
+
+class TradeDeduplicator(object):
+    '''Set of seen short exec ids kept as a sorted numpy array of their 64-bit hashes.
+    One deduplicator is used for a whole query so duplicates are dropped across days.
+    If path is given the hashes kept from every day file are loaded from/saved to that .npz file. Only the days before
+    the first of files are seen at the start, the queried days replace their saved hashes so a range can be re-queried.
+    The days before the oldest file are dropped from the file.'''
+    def __init__(self, pd, path=None, files=None, oldest=None):
+        import numpy as np
+        self.pd = pd
+        self.path = path
+        self.files = [os.path.basename(f) for f in files or []]
+        self.days = dict()
+        self.kept = dict()
+        self.seen = np.empty(0, dtype=np.uint64)
+        if path is not None and os.path.exists(path):
+            oldest = None if oldest is None else os.path.basename(oldest)
+            with np.load(path) as data:
+                self.days = {day: data[day] for day in data.files if oldest is None or day >= oldest}
+            first = min(self.files) if self.files else None
+            before = [hashes for day, hashes in self.days.items() if first is not None and day < first]
+            if before:
+                self.seen = np.unique(np.concatenate(before))
+
+    def hash(self, shortExecIds):
+        return self.pd.util.hash_pandas_object(shortExecIds, index=False).to_numpy()
+
+    def keepMask(self, hashes, file=None):
+        '''Returns a boolean array marking the first occurrence of every hash not seen before
+        and adds them to the seen hashes (and to the ones kept from file)'''
+        import numpy as np
+        first = np.zeros(len(hashes), dtype=bool)
+        first[np.unique(hashes, return_index=True)[1]] = True
+        pos = np.searchsorted(self.seen, hashes)
+        seen = np.zeros(len(hashes), dtype=bool)
+        inRange = pos < len(self.seen)
+        seen[inRange] = self.seen[pos[inRange]] == hashes[inRange]
+        mask = first & ~seen
+        # the new hashes are merged into the sorted seen ones instead of sorting them all again
+        new = np.sort(hashes[mask])
+        self.seen = np.insert(self.seen, np.searchsorted(self.seen, new), new)
+        if file is not None:
+            self.kept.setdefault(os.path.basename(file), list()).append(hashes[mask])
+        return mask
+
+    def save(self):
+        import numpy as np
+        if self.path is None:
+            return
+        for day in self.files:
+            kept = self.kept.get(day)
+            self.days[day] = np.concatenate(kept) if kept else np.empty(0, dtype=np.uint64)
+        # np.savez adds .npz to a file name without it so it's given an open file
+        with open(self.path + '.tmp', 'wb') as f:
+            np.savez(f, **self.days)
+        os.replace(self.path + '.tmp', self.path)
+
+def iterTradestoreFileChunks(pd, file, filter_=None, columns=None, skipZeroTrades=False, dropDuplicateTrades=False, cache=None, where=None, dtype=None,
+                             deduplicator=None, withHashes=False, accountIndex=None):
+    '''Generator over the chunks of a single tradestore day file with where, filter_, skipZeroTrades,
+    dropDuplicateTrades and columns applied. Duplicated trades are dropped against the exec ids seen
+    by deduplicator (TradeDeduplicator), a new one for the day if it's not given.
+    Only the columns needed for columns, where and the flags are read.
+    If cache (TradestoreCache) is given the parsed file is taken from/stored in it.
+    If accountIndex (TradestoreAccountIndex) is given and where has an ACCOUNT_ID lookup only the indexed blocks
+    with these accounts are read.
+    If withHashes is True (chunk, short exec id hashes) tuples are yielded.
+    Yields nothing if the file doesn't exist.'''
+    print('Parsing file: {}'.format(file))
+    if not os.path.exists(file):
+        print('Warning: file doesn\'t exist!')
+        return
+    usecols = getTradestoreUsecols(filter_, columns, where, skipZeroTrades, dropDuplicateTrades)
+    iter_csv = None
+    accounts = getAccountLookup(where)
+    if accountIndex is not None and accounts is not None:
+        iter_csv = accountIndex.readAccountRows(pd, file, accounts, usecols=usecols, dtype=dtype)
+    if iter_csv is None and cache is not None:
+        df = cache.get(pd, file, columns=usecols, dtype=dtype)
+        if df is None:
+            df = pd.read_csv(file, sep='|', compression='gzip', dtype=dtype)
+            cache.put(df, file, dtype)
+            if usecols is not None:
+                df = df[usecols]
+        else:
+            print('Loaded from cache: {}'.format(file))
+        iter_csv = [df]
+    elif iter_csv is None:
+        iter_csv = pd.read_csv(file, sep='|', compression='gzip', iterator=True, chunksize=100000, usecols=usecols, dtype=dtype)
+
+    if dropDuplicateTrades and deduplicator is None:
+        deduplicator = TradeDeduplicator(pd)
+    duplicated = 0
+    for chunk in iter_csv:
+        hashes = None
+        if filter_ is not None or where:
+            chunk = filterChunk(chunk, filter_, where)
+            # old logic-> df = pd.concat([chunk[filter_(chunk)][columns] for chunk in iter_csv])
+        #Remove trades with 0 quantity
+        if skipZeroTrades:
+            chunk = chunk[chunk['QUANTITY'] != 0]
+        #Remove duplicating trades
+        if dropDuplicateTrades:
+            chunk = chunk.copy()
+            chunk['EXEC_ID_SHORT'] = getShortExecIds(chunk['#EXEC_ID'])
+            hashes = deduplicator.hash(chunk['EXEC_ID_SHORT'])
+            mask = deduplicator.keepMask(hashes, file)
+            duplicated += len(chunk) - mask.sum()
+            chunk = chunk[mask]
+            hashes = hashes[mask]
+        if columns != None:
+            chunk = chunk[columns]
+        if withHashes:
+            yield chunk, hashes
+        else:
+            yield chunk
+    if dropDuplicateTrades:
+        print('Found {} duplicated exec_ids. Flag dropDuplicateTrades = true so droping them.'.format(duplicated))
+
+def parseTradestoreFile(pd, file, **kwargs):
+    '''Parses a single tradestore day file into a dataframe. See iterTradestoreFileChunks for the arguments.
+    Returns None if the file doesn't exist.'''
+    chunks = list(iterTradestoreFileChunks(pd, file, **kwargs))
+    if len(chunks) == 0:
+        return None
+    return pd.concat(chunks)
+
+# per process arguments for the tradestore pool workers. They are set by the pool initializer
+# and inherited through fork so filter_ can be a lambda and pd a module.
+tradestoreWorkerArgs = None
+
+def initTradestoreWorker(pd, kwargs):
+    global tradestoreWorkerArgs
+    tradestoreWorkerArgs = (pd, kwargs)
+
+def parseTradestoreFileWorker(file):
+    '''Returns the parsed day, the hashes of its short exec ids for the cross day de-duplication in the parent
+    and the parse time which the parent records in its metrics'''
+    import numpy as np
+    ts = time()
+    pd, kwargs = tradestoreWorkerArgs
+    chunks = list(iterTradestoreFileChunks(pd, file, withHashes=True, **kwargs))
+    if len(chunks) == 0:
+        return None, None, time() - ts
+    hashes = None
+    if kwargs['dropDuplicateTrades']:
+        hashes = np.concatenate([h for c, h in chunks])
+    return pd.concat([c for c, h in chunks]), hashes, time() - ts
+
+def recordTradestoreDay(file, elapsed, rows):
+    size = os.path.getsize(file) if os.path.exists(file) else 0
+    metrics.record('tradestoreDay', elapsed, {'rows': rows, 'bytes': size}, file=os.path.basename(file))
+
+def iterTradestoreFiles(pd, startDate, endDate, filter_=None, columns=None, skipZeroTrades=False, dropDuplicateTrades=False, workers=None, cache=None,
+                        where=None, dtype=None, perDay=False, dedupIndexFile=None, accountIndex=None):
+    '''Generator version of queryTradestoreFiles. Takes the same arguments and yields the filtered
+    chunks (or the day frames if perDay is True) in date order as they are parsed, so the whole
+    date range never has to be held in memory.
+    With workers > 1 the days are parsed in parallel and day frames are yielded.
+
+    Usage: for df in iterTradestoreFiles(pd, '20160101', '20160331', where=[('ACCOUNT_ID', '==', 'U123')]):
+               ...
+    '''
+    if where:
+        verifyPredicates(where)
+    kwargs = dict(filter_=filter_, columns=columns, skipZeroTrades=skipZeroTrades, dropDuplicateTrades=dropDuplicateTrades,
+                  cache=cache, where=where, dtype=dtype, accountIndex=accountIndex)
+    datelist = pd.date_range(start=pd.to_datetime(startDate, format='%Y%m%d'), end=pd.to_datetime(endDate, format='%Y%m%d'))
+    files = [TRADESTORE_FILE.format(dt) for dt in datelist.tolist()]
+    oldest = None
+    if DEDUP_RETENTION_DAYS is not None and len(datelist) > 0:
+        oldest = TRADESTORE_FILE.format(datelist[0] - timedelta(days=DEDUP_RETENTION_DAYS))
+    deduplicator = TradeDeduplicator(pd, dedupIndexFile, files, oldest) if dropDuplicateTrades else None
+    if workers is None or workers <= 1 or len(files) <= 1:
+        for file in files:
+            ts = time()
+            if perDay:
+                df = parseTradestoreFile(pd, file, deduplicator=deduplicator, **kwargs)
+                recordTradestoreDay(file, time() - ts, 0 if df is None else len(df))
+                if df is not None:
+                    yield df
+            else:
+                # the time the consumer spends on the chunks is not counted to the day
+                rows, waited = 0, 0
+                for chunk in iterTradestoreFileChunks(pd, file, deduplicator=deduplicator, **kwargs):
+                    rows += len(chunk)
+                    tw = time()
+                    yield chunk
+                    waited += time() - tw
+                recordTradestoreDay(file, time() - ts - waited, rows)
+    else:
+        import multiprocessing
+        # fork is needed so the lambda filters don't have to be pickled
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(min(workers, len(files)), initializer=initTradestoreWorker, initargs=(pd, kwargs)) as pool:
+            # imap keeps the order of the files so the days are yielded in date order
+            for file, (df, hashes, elapsed) in zip(files, pool.imap(parseTradestoreFileWorker, files, chunksize=1)):
+                recordTradestoreDay(file, elapsed, 0 if df is None else len(df))
+                if df is None:
+                    continue
+                if deduplicator is not None:
+                    # the workers drop the duplicates within a day, the ones across days are dropped here
+                    mask = deduplicator.keepMask(hashes, file)
+                    if not mask.all():
+                        print('Found {} exec_ids duplicated across days. Flag dropDuplicateTrades = true so droping them.'.format(len(mask) - mask.sum()))
+                        df = df[mask]
+                yield df
+    if deduplicator is not None:
+        deduplicator.save()
+
 @timeit
-def queryTradestoreFiles(pd, startDate, endDate, filter_=None, columns=None, skipZeroTrades=False, dropDuplicateTrades=False):
+def queryTradestoreFiles(pd, startDate, endDate, filter_=None, columns=None, skipZeroTrades=False, dropDuplicateTrades=False, workers=None, cache=None,
+                         where=None, dtype=None, dedupIndexFile=None, accountIndex=None, memoryBudgetMB=None, spillDir=None, lazy=False):
     '''Function to get data from tradestore files located at /home/users/csprod/ibcs/data/tradestore/IN/
     Params: startDate, endDate format YYYYMMDD
             filter example: filter = lambda df: df['COMPANY_ID'] == ''
             columns example: list of column names ['ACCOUNT_ID', 'EXCHANGE_NAME', 'CONTRACT']
-            
+            where: list of (column, op, value) predicates applied to every chunk while reading.
+                ops: ==, !=, <, <=, >, >=, in, not in, between
+                example: [('ACCOUNT_ID', 'in', ['U123', 'U456']), ('QUANTITY', '>', 0)]
+                When columns is given and filter_ is not, only columns and the predicate columns are read from the files.
+            dtype: dict of column dtypes passed to read_csv, ex. {'ACCOUNT_ID': str, 'QUANTITY': 'int64'}
+            workers: number of processes the days are parsed in. None or 1 parses the days one by one.
+                Every worker applies filter_, skipZeroTrades, dropDuplicateTrades and columns to its day
+                and returns only the reduced frame. The result is in date order and the same as the serial one.
+            cache: TradestoreCache object. The parsed days are kept in it and later queries skip the gzip/csv parsing.
+            dropDuplicateTrades: duplicated trades (same first 3 parts of #EXEC_ID) are dropped across the whole date range.
+            dedupIndexFile: .npz file with the hashes of the exec ids kept per day by previous runs. Trades seen in the
+                DEDUP_RETENTION_DAYS days before startDate are dropped and the queried days are replaced in the file at the end.
+            accountIndex: TradestoreAccountIndex object. When where has an ACCOUNT_ID == or in predicate only the
+                blocks of the indexed files with these accounts are decompressed and parsed.
+            memoryBudgetMB: the parsed days are kept in a SpillBuffer and spilled to files in spillDir (a temp dir by default)
+                when their memory passes the budget. They are read back and concatenated at the end.
+            lazy: with memoryBudgetMB the SpillBuffer is returned instead so the days can be iterated without
+                concatenating them. The caller closes it.
+    For bounded memory on long date ranges use iterTradestoreFiles.
+
             #Pos Column Name
 
     '''
-    
-    datelist = pd.date_range(start=pd.to_datetime(startDate, format='%Y%m%d'), end=pd.to_datetime(endDate, format='%Y%m%d'))
-    dfs = list()
-    for dt in datelist.tolist():
-        file = '/home/mhristov//IN/trades.data.{0:%Y%m%d}.gz'.format(dt)
-        print('Parsing file: {}'.format(file))
-        if os.path.exists(file):
-            iter_csv = pd.read_csv(file, sep='|', compression='gzip', iterator=True, chunksize=100000)
-            if filter_ == None:
-                df = pd.concat([chunk for chunk in iter_csv])
-            else:
-                df = pd.concat([chunk[filter_(chunk)] for chunk in iter_csv])
-                # old logic-> df = pd.concat([chunk[filter_(chunk)][columns] for chunk in iter_csv])
-            
-            #Remove trades with 0 quantity
-            if skipZeroTrades:
-                df = df[df['QUANTITY'] != 0]
-            #Remove duplicating trades 
-            if dropDuplicateTrades:
-                df['EXEC_ID_SHORT'] = df['#EXEC_ID'].map(lambda x: '.'.join(x.split('.')[:3]))
-                print('Found {} duplicated exec_ids. Flag dropDuplicateTrades = true so droping them.'.format(len(df[df['EXEC_ID_SHORT'].duplicated()])))
-                df.drop_duplicates(['EXEC_ID_SHORT'], inplace=True)
-                 
-            if columns == None:
-                dfs.append(df)
-            else:
-                dfs.append(df[columns])
-        else:
-            print('Warning: file doesn\'t exist!')
-    dfAll = pd.concat(dfs)
+    days = iterTradestoreFiles(pd, startDate, endDate, filter_=filter_, columns=columns, skipZeroTrades=skipZeroTrades,
+                               dropDuplicateTrades=dropDuplicateTrades, workers=workers, cache=cache, where=where, dtype=dtype, perDay=True,
+                               dedupIndexFile=dedupIndexFile, accountIndex=accountIndex)
+    if memoryBudgetMB is None:
+        return pd.concat(list(days))
+    buffer = SpillBuffer(pd, memoryBudgetMB, spillDir)
+    try:
+        for df in days:
+            buffer.append(df)
+    except BaseException:
+        # the parts spilled before the failure are removed
+        buffer.close()
+        raise
+    if lazy:
+        return buffer
+    with buffer:
+        dfAll = buffer.concat()
     return dfAll
 
 def convertSequenceToDict(list_):
@@ -163,25 +820,153 @@ def convertSequenceToDict(list_):
         dic[str(k)] = v
     return dic
 
-def writeDataFrame(conn, tableName, df, commit_=True):
+def columnToList(series):
+    '''Returns the values of a series as a list of python objects with None for the nulls'''
+    values = series.to_numpy(dtype=object)
+    nulls = series.isnull().to_numpy()
+    if nulls.any():
+        values[nulls] = None
+    return values.tolist()
+
+def getInputSizes(df):
+    '''Returns the cx_Oracle bind types of the columns of df for cursor.setinputsizes'''
+    import numpy as np
+    from pandas.api.types import infer_dtype
+    sizes = list()
+    for c in df.columns:
+        dt = df[c].dtype
+        if issubclass(dt.type, np.datetime64):
+            sizes.append(cx_Oracle.TIMESTAMP)
+        elif issubclass(dt.type, np.floating):
+            sizes.append(cx_Oracle.NATIVE_FLOAT)
+        elif issubclass(dt.type, (np.integer, np.bool_)):
+            sizes.append(int)
+        elif len(df) > 0 and infer_dtype(df[c], skipna=True) == 'string':
+            sizes.append(max(1, int(df[c].str.len().max())))
+        else:
+            sizes.append(None)
+    return sizes
+
+def writeDataFrame(conn, tableName, df, commit_=True, batchSize=50000, batchErrors=False, parallel=None, dbAlias=None, commitPolicy='shard',
+                   hint=None):
     '''Function to write pandas dataframe to a table.
     The table must exists in the database. It is not created automatically.
     Currently the function does not support CLOBs.
+    The rows are bound as positional arrays built column by column and sent batchSize rows per executemany.
+    If batchErrors is True the rows failing in a batch are reported and the rest are inserted.
+    Returns the list of (row number, error message) of the failed rows.
+    parallel: number of row shards inserted at the same time, each on its own connection to dbAlias.
+    commitPolicy (with parallel):
+        'shard': every shard is committed when it's inserted. A failed shard leaves the others in the table.
+        'staging': the shards are inserted in a staging copy of the table which is moved to the table
+            with a single insert as select on conn, so either all the rows are inserted or none.
+            The staging table DDL commits on conn so the rows are always committed.
+    hint: optimizer hint of the insert, ex. 'APPEND_VALUES' for a direct path insert. A direct path insert
+        locks the table until the commit, so don't use it with parallel.
+    conn can also be a sqlite3 connection (ex. for the benchmarks), batchErrors is not supported on it.
     '''
+    import sqlite3
+    import numpy as np
+    if parallel is not None and parallel > 1:
+        return writeDataFrameParallel(conn, tableName, df, parallel, dbAlias, commitPolicy, commit_, batchSize, batchErrors, hint)
+    isSqlite = isinstance(conn, sqlite3.Connection)
+    if isSqlite and batchErrors:
+        raise Exception('batchErrors is not supported on sqlite')
     cur = conn.cursor()
-    df = df.where(df.notnull(),None)
     cols = df.columns
     colnames = ', '.join(cols)
-    colpos = ', '.join(':'+str(i+1) for i,f in enumerate(cols))
+    if isSqlite:
+        colpos = ', '.join('?' for c in cols)
+    else:
+        colpos = ', '.join(':'+str(i+1) for i,f in enumerate(cols))
     
-    insertSql = 'insert into {0} ({1}) values ({2})'.format(tableName, colnames, colpos)
-    cur.prepare(insertSql)
-    data = [convertSequenceToDict(rec) for rec in df.values]
-    cur.executemany(None, data)
-    print('{} rows inserted.'.format(cur.rowcount))
+    insertSql = 'insert {3}into {0} ({1}) values ({2})'.format(tableName, colnames, colpos, '/*+ {} */ '.format(hint) if hint else '')
+    dateCols = list()
+    if isSqlite:
+        # sqlite3 doesn't bind pandas timestamps so they are sent as text
+        dateCols = [c for c in cols if issubclass(df[c].dtype.type, np.datetime64)]
+        statement = insertSql
+    else:
+        cur.prepare(insertSql)
+        cur.setinputsizes(*getInputSizes(df))
+        statement = None
+    inserted = 0
+    roundTrips = 0
+    errors = list()
+    for start in range(0, len(df), batchSize):
+        batch = df.iloc[start:start + batchSize]
+        data = list(zip(*[columnToList(batch[c].dt.strftime('%Y-%m-%d %H:%M:%S') if c in dateCols else batch[c]) for c in cols]))
+        if batchErrors:
+            cur.executemany(None, data, batcherrors=True)
+            for error in cur.getbatcherrors():
+                errors.append((start + error.offset, error.message))
+                print('Row {} not inserted: {}'.format(start + error.offset, error.message))
+        else:
+            cur.executemany(statement, data)
+        inserted += cur.rowcount
+        roundTrips += 1
+    print('{} rows inserted.'.format(inserted))
+    metrics.add(rows=inserted, roundTrips=roundTrips)
     if commit_:
         conn.commit()
+    return errors
     
+def writeDataFrameShard(dbAlias, tableName, shard, shardNo, start, batchSize, batchErrors, results, hint=None):
+    conn = getDbConnection(dbAlias, pooled=True)
+    try:
+        ts = time()
+        with metrics.span('shard', shard=shardNo):
+            errors = writeDataFrame(conn, tableName, shard, commit_=True, batchSize=batchSize, batchErrors=batchErrors, hint=hint)
+        elapsed = time() - ts
+        print('Shard {}: {} rows in {:.1f}s ({:.0f} rows/s)'.format(shardNo, len(shard), elapsed, len(shard) / elapsed if elapsed > 0 else 0))
+        results[shardNo] = [(start + row, message) for row, message in errors]
+    except Exception as e:
+        print('Shard {} failed: {}'.format(shardNo, e))
+        results[shardNo] = e
+    finally:
+        conn.close()
+
+def writeDataFrameParallel(conn, tableName, df, parallel, dbAlias, commitPolicy='shard', commit_=True, batchSize=50000, batchErrors=False, hint=None):
+    '''Inserts df split in parallel row shards, each on its own connection. See writeDataFrame.'''
+    if dbAlias is None:
+        raise Exception('dbAlias is needed for the shard connections of a parallel write')
+    if commitPolicy not in ('shard', 'staging'):
+        raise Exception('Unknown commitPolicy {}'.format(commitPolicy))
+    target = tableName
+    cur = conn.cursor()
+    if commitPolicy == 'staging':
+        # the table name part is cut to keep the suffix within the 30 chars of an oracle identifier, the schema is kept
+        schema, _, name = tableName.rpartition('.')
+        suffix = '_STG{}'.format(os.getpid())
+        target = (schema + '.' if schema else '') + name[:30 - len(suffix)] + suffix
+        cur.execute('create table {} as select * from {} where 1=0'.format(target, tableName))
+
+    bounds = [len(df) * i // parallel for i in range(parallel + 1)]
+    results = dict()
+    threads = list()
+    for i in range(parallel):
+        shard = df.iloc[bounds[i]:bounds[i + 1]]
+        t = threading.Thread(target=metrics.wrap(writeDataFrameShard), args=(dbAlias, target, shard, i, bounds[i], batchSize, batchErrors, results, hint))
+        threads.append(t)
+        t.start()
+    for t in threads:
+        t.join()
+
+    failed = [i for i in results if isinstance(results[i], Exception)]
+    try:
+        if failed:
+            raise Exception('Shard(s) {} of {} failed: {}'.format(failed, tableName, [str(results[i]) for i in failed]))
+        if commitPolicy == 'staging':
+            cur.execute('insert /*+ APPEND */ into {} select * from {}'.format(tableName, target))
+            print('{} rows moved from {} to {}.'.format(cur.rowcount, target, tableName))
+            if commit_:
+                conn.commit()
+    finally:
+        if commitPolicy == 'staging':
+            cur.execute('drop table {} purge'.format(target))
+        cur.close()
+    return [error for i in sorted(results) for error in results[i]]
+
 def memory_usage():
     '''Function to get the memory used by the script this function is called from in MB '''
     import resource
@@ -189,8 +974,331 @@ def memory_usage():
     mem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / rusage_denom
     return mem
 
+class SpillBuffer(object):
+    '''Ordered buffer of dataframes kept under a memory budget. The memory of the buffered frames is
+    tracked with memory_usage(deep=True) and when it passes budgetMB they are written to a feather file
+    (pickle if the frame can't be stored in feather) in spillDir and read back when iterated.
+    The index of the frames is kept.
+
+    Usage: with SpillBuffer(pd, 2048) as buffer:
+               for df in iterTradestoreFiles(pd, '20160101', '20161231', perDay=True):
+                   buffer.append(df)
+               for df in buffer:      # or dfAll = buffer.concat()
+                   ...
+    '''
+    def __init__(self, pd, budgetMB, spillDir=None):
+        import tempfile
+        self.pd = pd
+        self.budget = budgetMB * 1024 * 1024
+        self.ownDir = spillDir is None
+        self.spillDir = tempfile.mkdtemp(prefix='spill') if spillDir is None else spillDir
+        os.makedirs(self.spillDir, exist_ok=True)
+        # parts in append order: a dataframe or the (path, index names) of a spilled part
+        self.parts = list()
+        self.memory = 0
+        self.spilledParts = 0
+
+    def append(self, df):
+        self.parts.append(df)
+        self.memory += int(df.memory_usage(deep=True).sum())
+        if self.memory > self.budget:
+            self.spill()
+
+    def spill(self):
+        '''Writes the buffered frames to one file'''
+        frames = [p for p in self.parts if not isinstance(p, tuple)]
+        if len(frames) == 0:
+            return
+        df = self.pd.concat(frames) if len(frames) > 1 else frames[0]
+        path = os.path.join(self.spillDir, 'part{}.{}'.format(os.getpid(), self.spilledParts))
+        indexNames = list(df.index.names)
+        flat = df.reset_index()
+        flat.columns = ['__index_level_{}__'.format(i) for i in range(len(indexNames))] + list(df.columns)
+        try:
+            flat.to_feather(path + '.feather')
+            path += '.feather'
+        except Exception:
+            if os.path.exists(path + '.feather'):
+                os.remove(path + '.feather')
+            path += '.pkl'
+            df.to_pickle(path)
+        print('Spilled {} rows ({:.0f}MB) to {}'.format(len(df), self.memory / 1024 / 1024, path))
+        metrics.add(spilledRows=len(df), spilledBytes=os.path.getsize(path))
+        del df, flat, frames
+        # the spilled frames are replaced by one part at the place of the first one
+        first = next(i for i, p in enumerate(self.parts) if not isinstance(p, tuple))
+        self.parts = self.parts[:first] + [(path, indexNames)]
+        self.memory = 0
+        self.spilledParts += 1
+
+    def read(self, part):
+        path, indexNames = part
+        if path.endswith('.pkl'):
+            return self.pd.read_pickle(path)
+        df = self.pd.read_feather(path)
+        indexColumns = list(df.columns[:len(indexNames)])
+        df = df.set_index(indexColumns)
+        df.index.names = indexNames
+        return df
+
+    def __iter__(self):
+        for part in self.parts:
+            yield self.read(part) if isinstance(part, tuple) else part
+
+    def __len__(self):
+        return len(self.parts)
+
+    def concat(self):
+        '''Returns all the frames concatenated. The spilled parts are read back one by one.'''
+        return self.pd.concat(list(self))
+
+    def close(self):
+        import shutil
+        for part in self.parts:
+            if isinstance(part, tuple) and os.path.exists(part[0]):
+                os.remove(part[0])
+        self.parts = list()
+        self.memory = 0
+        if self.ownDir:
+            shutil.rmtree(self.spillDir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+# lookups done for every chunk of accts after the customer account one:
+# (name, table object, column of the customer account result used as key, key column of the empty frame)
+ACCT_PROPERTIES_LOOKUPS = (('applicant', 'applicantObj', 'applicant_id', 'id'),
+                           ('accountHierarchy', 'accountHierarchyObj', 'acct_id', 'sub_acct_id'),
+                           ('universalAccount', 'universalAcctObj', 'acct_id', 'acct_id'),
+                           ('acctCapability', 'acctCapabilityObj', 'acct_id', 'acct_id'),
+                           ('ibUser', 'custAcctUsersObj', 'acct_id', 'acct_id'),
+                           ('individual', 'entityAssocObj', 'applicant_id', 'applicant_id'),
+                           ('repAcctFinSum', 'repAcctFinSumObj', 'acct_id', 'acct_id'),
+                           ('cashBalSum', 'cashBalSumObj', 'acct_id', 'acct_id'))
+
+@metrics.timed('acctsChunk')
+def getChunkAcctsProperties(pd, sa, engine, tableObjsDict, chunk, allColumns, columns, executor=None, conn=None, stageTable=None, arraysize=None):
+    '''Gets and merges the properties of a chunk of accts. If executor is given the lookups
+    depending only on the customer account result are run concurrently in it.
+    If stageTable is given the acct and applicant ids are staged in it on conn and every lookup
+    is a single query joined to the staged keys.'''
+    accts = len(chunk)
+    if stageTable is not None:
+        chunk = loadStagedKeys(sa, conn, stageTable, 'acct_id', chunk)
+    args = (pd, sa, engine, tableObjsDict['customerAccountObj'], chunk, allColumns, columns, conn, arraysize)
+    if executor is None:
+        dfCustomerAccount = getDfFromTableObj(*args)
+    else:
+        dfCustomerAccount = executor.submit(metrics.wrap(getDfFromTableObj), *args).result()
+    # dfCustomerAccount.head()
+    keys = dfCustomerAccount
+    if stageTable is not None:
+        keys = {'acct_id': chunk, 'applicant_id': loadStagedKeys(sa, conn, stageTable, 'applicant_id', dfCustomerAccount['applicant_id'])}
+    lookups = dict()
+    for name, tableObj, keyColumn, emptyColumn in ACCT_PROPERTIES_LOOKUPS:
+        args = (pd, sa, engine, tableObjsDict[tableObj], keys[keyColumn], allColumns, columns, conn, arraysize)
+        if executor is None:
+            lookups[name] = getDfFromTableObj(*args)
+        else:
+            lookups[name] = executor.submit(metrics.wrap(getDfFromTableObj), *args)
+    for name, tableObj, keyColumn, emptyColumn in ACCT_PROPERTIES_LOOKUPS:
+        if executor is not None:
+            lookups[name] = lookups[name].result()
+        if lookups[name] is None:
+            lookups[name] = pd.DataFrame(columns=[emptyColumn])
+
+    dfAll = dfCustomerAccount
+    dfAll = attachLookup(dfAll, lookups['applicant'], 'applicant_id', 'id', columns, ('', '_applicant'))
+    dfAll = attachLookup(dfAll, lookups['accountHierarchy'], 'acct_id', 'sub_acct_id', columns)
+    dfAll = attachLookup(dfAll, lookups['ibUser'], 'acct_id', 'acct_id', columns, ('','_ibUser'))
+    dfAll = attachLookup(dfAll, lookups['universalAccount'], 'acct_id', 'acct_id', columns, ('','_universalAccount'))
+    dfAll = attachLookup(dfAll, lookups['acctCapability'], 'acct_id', 'acct_id', columns)
+    dfAll = attachLookup(dfAll, lookups['individual'], 'applicant_id', 'applicant_id', columns, ('','_individual'))
+    dfAll = attachLookup(dfAll, lookups['repAcctFinSum'], 'acct_id', 'acct_id', columns, ('','_rep_acct_fin_summary'))
+    dfAll = attachLookup(dfAll, lookups['cashBalSum'], 'acct_id', 'acct_id', columns, ('','_acct_cash_bal_summ'))
+
+#         dfAll.info()
+    if 'id' in dfAll.columns: del(dfAll['id'])
+    if 'sub_acct_id' in dfAll.columns: del(dfAll['sub_acct_id'])
+    if 'applicant_id' not in columns: del(dfAll['applicant_id'])
+    # if 'user_id' not in columns: del(dfAll['user_id'])
+    if 'applicant_id_universalAccount' in dfAll.columns: del(dfAll['applicant_id_universalAccount'])
+    if 'applicant_id_rep_acct_fin_summary' in dfAll.columns: del(dfAll['applicant_id_rep_acct_fin_summary'])
+    # rows can only repeat where a lookup had more than one row per key, the index of these rows repeats
+    if not dfAll.index.is_unique:
+        dfAll = dfAll.drop_duplicates()
+    metrics.add(accts=accts, rows=len(dfAll))
+    return dfAll
+
+def attachLookup(dfAll, lookup, leftOn, rightOn, columns, suffixes=('_x', '_y')):
+    '''Left joins the requested columns of lookup to dfAll on dfAll[leftOn] == lookup[rightOn].
+    The lookup is indexed on its key once. If the key is unique the columns are attached to dfAll
+    column-wise, otherwise they are joined and the index of dfAll repeats for the extra rows.
+    Overlapping columns get suffixes like in DataFrame.merge.'''
+    carried = [c for c in lookup.columns if c in columns and c not in (leftOn, rightOn)]
+    if len(carried) == 0:
+        return dfAll
+    right = lookup[[rightOn] + carried].set_index(rightOn)
+    overlap = [c for c in carried if c in dfAll.columns]
+    if overlap:
+        dfAll = dfAll.rename(columns=dict((c, c + suffixes[0]) for c in overlap))
+        right = right.rename(columns=dict((c, c + suffixes[1]) for c in overlap))
+    if right.index.is_unique:
+        aligned = right.reindex(dfAll[leftOn].values)
+        for c in aligned.columns:
+            dfAll[c] = aligned[c].values
+        return dfAll
+    return dfAll.join(right, on=leftOn, how='left')
+
+# tables of getAcctsProperties and its special columns not available in them
+ACCT_PROPERTIES_TABLES = ['CUSTOMER', 'APPLICANT', 'ACCOUNT', 'CUSTOMERACCOUNTUSER']
+ACCT_DUMMY_COLUMNS = ['type', 'country', 'region', 'unreal']
+
+class AcctPropertiesCache(object):
+    '''Cache of getAcctsProperties results keyed by acct_id and the fetched columns.
+    Every entry holds the result rows of the acct as tuples so the values of accts with several rows stay paired.
+    A lookup is served by any entry of the acct with all the requested columns.
+    ttl: seconds an entry is valid
+    path: if given the cache is loaded from/saved to this pickle file so it's kept across runs
+
+    Usage: cache = AcctPropertiesCache(ttl=3600, path='/home/mhristov/tmp/acctProperties.pkl')
+           df = getAcctsProperties(engine, accts, ['acct_type', 'is_stl'], cache=cache)
+           cache.save()
+    '''
+    def __init__(self, ttl=86400, path=None):
+        self.ttl = ttl
+        self.path = path
+        # acct -> {columns: (time, rows)}
+        self.entries = dict()
+        if path is not None and os.path.exists(path):
+            import pickle
+            with open(path, 'rb') as f:
+                self.entries = pickle.load(f)
+
+    def get(self, acct, columns):
+        '''Returns the rows of acct with the values of columns or None on a cache miss.
+        An acct without rows has none for any columns.'''
+        now = time()
+        for cachedColumns, (ts, rows) in self.entries.get(acct, {}).items():
+            if now - ts >= self.ttl:
+                continue
+            if not rows:
+                return []
+            if set(columns) <= set(cachedColumns):
+                pos = [cachedColumns.index(c) for c in columns]
+                return [tuple(row[i] for i in pos) for row in rows]
+        return None
+
+    def getSingleRow(self, acct):
+        '''Returns {column: value} of the cached columns of acct if it has a single row, None if an entry has several rows'''
+        now = time()
+        row = dict()
+        for cachedColumns, (ts, rows) in self.entries.get(acct, {}).items():
+            if now - ts >= self.ttl:
+                continue
+            if len(rows) > 1:
+                return None
+            if rows:
+                row.update(zip(cachedColumns, rows[0]))
+        return row
+
+    def put(self, acct, columns, rows):
+        columns = tuple(columns)
+        entries = self.entries.setdefault(acct, dict())
+        # entries with a subset of the columns are replaced by the new one
+        for cachedColumns in [c for c in entries if set(c) <= set(columns)]:
+            del entries[cachedColumns]
+        entries[columns] = (time(), [tuple(row) for row in rows])
+
+    def save(self):
+        import pickle
+        if self.path is None:
+            return
+        now = time()
+        entries = dict()
+        for acct, acctEntries in self.entries.items():
+            acctEntries = dict((k, v) for k, v in acctEntries.items() if now - v[0] < self.ttl)
+            if acctEntries:
+                entries[acct] = acctEntries
+        self.entries = entries
+        with open(self.path + '.tmp', 'wb') as f:
+            pickle.dump(self.entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.path + '.tmp', self.path)
+
+def getCachedAcctsProperties(pd, engine, acctSeries, columns, cache, **kwargs):
+    '''getAcctsProperties with an AcctPropertiesCache. Only the (acct, column) pairs missing in the cache are fetched.
+    The missing columns of an acct with a single row are merged into its cached row. An acct with several rows is
+    fetched again with all the columns, so its rows are never assembled from different queries.
+    The dummy columns are left out of the result as getAcctsProperties does.'''
+    snapshot = getCatalogSnapshot(engine, ACCT_PROPERTIES_TABLES)
+    tableColumns = set().union(*snapshot.values())
+    columns = [c for c in columns if c != 'acct_id' and (c.upper() in tableColumns or c not in ACCT_DUMMY_COLUMNS)]
+    accts = pd.Series(acctSeries).drop_duplicates().tolist()
+
+    def fetch(accts, fetchColumns):
+        '''Returns {acct: list of row tuples} of accts'''
+        df = getAcctsProperties(engine, accts, fetchColumns, **kwargs)
+        fetched = dict((a, list()) for a in accts)
+        for acct, values in zip(df['ACCT_ID'], df[[c.upper() for c in fetchColumns]].itertuples(index=False)):
+            fetched.setdefault(acct, list()).append(tuple(values))
+        return fetched
+
+    rows = dict((a, cache.get(a, columns)) for a in accts)
+    # accts with a single cached row are grouped by their missing columns so every group fetches only what it misses
+    missing = defaultdict(list)
+    refetch = list()
+    for a in accts:
+        if rows[a] is not None:
+            continue
+        known = cache.getSingleRow(a)
+        if known is None:
+            refetch.append(a)
+        elif columns and all(c in known for c in columns):
+            # the columns are in several single row entries
+            rows[a] = [tuple(known[c] for c in columns)]
+            cache.put(a, columns, rows[a])
+        else:
+            missing[tuple(c for c in columns if c not in known)].append(a)
+    print('Acct properties cache: {} of {} accts missing'.format(len(refetch) + sum(len(m) for m in missing.values()), len(accts)))
+    for missingColumns, missingAccts in missing.items():
+        for acct, values in fetch(missingAccts, list(missingColumns)).items():
+            known = cache.getSingleRow(acct)
+            if not known:
+                # nothing was cached, all the columns are fetched
+                rows[acct] = values
+                cache.put(acct, columns, values)
+                continue
+            if len(values) > 1:
+                # the acct has several rows for the missing columns
+                refetch.append(acct)
+                continue
+            if values:
+                known.update(zip(missingColumns, values[0]))
+            # accts without rows are cached with no rows
+            rows[acct] = [tuple(known[c] for c in columns)] if values else []
+            cache.put(acct, columns, rows[acct])
+    if refetch:
+        for acct, values in fetch(refetch, columns).items():
+            rows[acct] = values
+            cache.put(acct, columns, values)
+
+    data = dict((c, list()) for c in ['acct_id'] + columns)
+    for acct in accts:
+        n = len(rows[acct]) if columns else 1
+        data['acct_id'].extend([acct] * n)
+        for i, c in enumerate(columns):
+            data[c].extend(row[i] for row in rows[acct])
+    df = pd.DataFrame(data)
+    df.drop_duplicates(inplace=True)
+    df.columns = df.columns.str.upper()
+    return df.reset_index(drop=True)
+
 @timeit
-def getAcctsProperties(engine, acctSeries, columns):
+def getAcctsProperties(engine, acctSeries, columns, concurrency=1, stageKeys=False, cache=None, arraysize=None, memoryBudgetMB=None, spillDir=None):
     '''Function to get acct properties from different tables in the database based on a series/list of accts.
     Supported tables:
         CUSTOMER, APPLICANT, ACCOUNT, CUSTOMERACCOUNTUSER
@@ -202,15 +1310,29 @@ def getAcctsProperties(engine, acctSeries, columns):
             dummy columns can be provided for calling various plsql function
             supported dummy columns:
                 ['type', 'country', 'region', 'unreal']
+        concurrency: max number of queries run at the same time. The lookups of a chunk which don't
+            depend on each other and consecutive chunks are run concurrently on the pooled connections
+            of the engine. The engine pool (pool_size + max_overflow) should allow that many connections.
+        stageKeys: if True the accts are bulk loaded once in the ACCT_KEY_STAGE global temporary table
+            instead of being split in 990 long IN-lists and every lookup is a single query joined to it.
+            All the queries run in one session so concurrency is ignored.
+        cache: AcctPropertiesCache object. Only the accts missing in it are fetched and the
+            result has ACCT_ID and the requested columns.
+        arraysize: if given the lookups are fetched arraysize rows at a time from server side cursors
+            and their frames are built batch by batch
+        memoryBudgetMB: the chunk results are kept in a SpillBuffer and spilled to files in spillDir (a temp dir by default)
+            when their memory passes the budget
     '''
     import pandas as pd
     import sqlalchemy as sa
+    from concurrent.futures import ThreadPoolExecutor
     
     columns = list(map(str.lower, columns))
+    if cache is not None:
+        return getCachedAcctsProperties(pd, engine, acctSeries, columns, cache, concurrency=concurrency, stageKeys=stageKeys, arraysize=arraysize,
+                                        memoryBudgetMB=memoryBudgetMB, spillDir=spillDir)
 
-    tables = ['CUSTOMER', 'APPLICANT', 'ACCOUNT',
-              'CUSTOMERACCOUNTUSER']
-    tables = list(map(str.upper, tables))
+    tables = list(ACCT_PROPERTIES_TABLES)
     
     tableObjs = ('customerAccountObj', 'applicantObj', 'accountHierarchyObj',
                  'custAcctUsersObj', 'universalAcctObj', 'acctCapabilityObj',
@@ -218,8 +1340,7 @@ def getAcctsProperties(engine, acctSeries, columns):
     
     tableObjsDict = dict(zip(tableObjs, tables))
 
-    # special columns not available in the supported tables
-    dummyColumns = ['type', 'country', 'region', 'unreal']
+    dummyColumns = ACCT_DUMMY_COLUMNS
 
     checkIfColumnsInTables(engine, tables, columns, dummyColumns)
 
@@ -239,89 +1360,111 @@ def getAcctsProperties(engine, acctSeries, columns):
     
     if type(acctSeries) == list:
         acctSeries = pd.Series(acctSeries)
+    # the keys are de-duplicated once here instead of the result
+    acctSeries = acctSeries.drop_duplicates()
     
     chunks = list()
-    dfs = list()
+    dfs = list() if memoryBudgetMB is None else SpillBuffer(pd, memoryBudgetMB, spillDir)
 #     if len(acctSeries) > 999 and len(acctSeries) < 1900:
 #         chunks = array_split(acctSeries, 2)
 #     elif len(acctSeries) >= 1900:
 #         chunks = array_split(acctSeries, len(acctSeries)//800)
 #     else:
 #         chunks.append(acctSeries)
-    chunks = split_array(acctSeries, 990)
+    if stageKeys:
+        chunks = [acctSeries]
+    else:
+        chunks = split_array(acctSeries, 990)
     
     bar = pyprind.ProgBar(len(chunks), monitor=True, title='getAcctsProperties')
-    for chunk in chunks:
-        dfCustomerAccount = getDfFromTableObj(pd, sa, engine, tableObjsDict['customerAccountObj'], chunk, allColumns, columns)
-        # dfCustomerAccount.head()
-        dfApplicant = getDfFromTableObj(pd, sa, engine, tableObjsDict['applicantObj'], dfCustomerAccount.applicant_id, allColumns, columns)
-        if dfApplicant is None:
-            dfApplicant = pd.DataFrame(columns=['id'])
-        dfAccountHierarchy = getDfFromTableObj(pd, sa, engine, tableObjsDict['accountHierarchyObj'], dfCustomerAccount.acct_id, allColumns, columns)
-        if dfAccountHierarchy is None:
-            dfAccountHierarchy = pd.DataFrame(columns=['sub_acct_id'])
-        dfUniversalAccount = getDfFromTableObj(pd, sa, engine, tableObjsDict['universalAcctObj'], dfCustomerAccount.acct_id, allColumns, columns)
-        if dfUniversalAccount is None:
-            dfUniversalAccount = df = pd.DataFrame(columns=['acct_id'])
-        dfAcctCapability = getDfFromTableObj(pd, sa, engine, tableObjsDict['acctCapabilityObj'], dfCustomerAccount.acct_id, allColumns, columns)
-        if dfAcctCapability is None:
-            dfAcctCapability = pd.DataFrame(columns=['acct_id'])
-        dfIbUser = getDfFromTableObj(pd, sa, engine, tableObjsDict['custAcctUsersObj'], dfCustomerAccount.acct_id, allColumns, columns)
-        if dfIbUser is None:
-            dfIbUser = pd.DataFrame(columns=['acct_id'])
-        dfIndividual = getDfFromTableObj(pd, sa, engine, tableObjsDict['entityAssocObj'], dfCustomerAccount.applicant_id, allColumns, columns)
-        if dfIndividual is None:
-            dfIndividual = df = pd.DataFrame(columns=['applicant_id'])
-        dfRepAcctFinSum = getDfFromTableObj(pd, sa, engine, tableObjsDict['repAcctFinSumObj'], dfCustomerAccount.acct_id, allColumns, columns)
-        if dfRepAcctFinSum is None:
-            dfRepAcctFinSum = df = pd.DataFrame(columns=['acct_id'])
-        dfCashBalSum = getDfFromTableObj(pd, sa, engine, tableObjsDict['cashBalSumObj'], dfCustomerAccount.acct_id, allColumns, columns)
-        if dfCashBalSum is None:
-            dfCashBalSum = df = pd.DataFrame(columns=['acct_id'])
-        
-        dfAll = dfCustomerAccount.merge(dfApplicant, how='left', left_on='applicant_id', right_on='id', suffixes=('', '_applicant'))
-        dfAll = dfAll.merge(dfAccountHierarchy, how='left', left_on='acct_id', right_on='sub_acct_id')
-        dfAll = dfAll.merge(dfIbUser, how='left', on='acct_id', suffixes=('','_ibUser'))
-        dfAll = dfAll.merge(dfUniversalAccount, how='left', on='acct_id', suffixes=('','_universalAccount'))
-        dfAll = dfAll.merge(dfAcctCapability, how='left', on='acct_id')
-        dfAll = dfAll.merge(dfIndividual, how='left', on='applicant_id', suffixes=('','_individual'))
-        dfAll = dfAll.merge(dfRepAcctFinSum, how='left', on='acct_id', suffixes=('','_rep_acct_fin_summary'))
-        dfAll = dfAll.merge(dfCashBalSum, how='left', on='acct_id', suffixes=('','_acct_cash_bal_summ'))
-        
-#         dfAll.info()
-        del(dfAll['id'])
-        del(dfAll['sub_acct_id'])
-        if 'applicant_id' not in columns: del(dfAll['applicant_id'])
-        # if 'user_id' not in columns: del(dfAll['user_id'])
-        if 'applicant_id_universalAccount' in dfAll.columns: del(dfAll['applicant_id_universalAccount'])
-        if 'applicant_id_rep_acct_fin_summary' in dfAll.columns: del(dfAll['applicant_id_rep_acct_fin_summary'])
-        dfs.append(dfAll)
-#         print(dfs)
-        bar.update()
-    if len(dfs) > 0:
-        df = pd.concat(dfs)
-        df.drop_duplicates(inplace=True)
-        df.columns = df.columns.str.upper()
-        df = df.reset_index(drop=True)
-
-    else:
-        # if resultset is empty return empty dataframe with the parsed columns
-        columns.insert(0, 'acct_id')
-        df = pd.DataFrame(columns=[c.upper() for c in columns])
+    try:
+        if stageKeys:
+            conn = engine.connect()
+            try:
+                stageTable = getKeyStageTable(sa, engine, conn)
+                dfs.append(getChunkAcctsProperties(pd, sa, engine, tableObjsDict, acctSeries, allColumns, columns, conn=conn, stageTable=stageTable,
+                                                   arraysize=arraysize))
+                conn.execute(stageTable.delete())
+            finally:
+                conn.close()
+            bar.update()
+        elif concurrency is None or concurrency <= 1:
+            for chunk in chunks:
+                dfs.append(getChunkAcctsProperties(pd, sa, engine, tableObjsDict, chunk, allColumns, columns, arraysize=arraysize))
+#             print(dfs)
+                bar.update()
+        else:
+            # the chunk threads only wait for their lookups, all the queries run in the lookup pool
+            with ThreadPoolExecutor(concurrency) as lookupExecutor, ThreadPoolExecutor(concurrency) as chunkExecutor:
+                futures = [chunkExecutor.submit(metrics.wrap(getChunkAcctsProperties), pd, sa, engine, tableObjsDict, chunk, allColumns, columns, lookupExecutor,
+                                                arraysize=arraysize)
+                           for chunk in chunks]
+                # results are collected in chunk order so the result is the same as the serial one
+                for future in futures:
+                    dfs.append(future.result())
+                    bar.update()
+        if len(dfs) > 0:
+            df = pd.concat(list(dfs))
+            df.columns = df.columns.str.upper()
+            df = df.reset_index(drop=True)
 
+        else:
+            # if resultset is empty return empty dataframe with the parsed columns
+            columns.insert(0, 'acct_id')
+            df = pd.DataFrame(columns=[c.upper() for c in columns])
+    finally:
+        # the spilled chunk results are removed even if a chunk fails
+        if memoryBudgetMB is not None:
+            dfs.close()
     print(bar)
     return df
 
-def filterTablesByColumns(engine, tables, columns):
-    # conn = engine.connect()
+# per engine url and table set snapshot of the catalog: (url, tables) -> {table_name: set of column names}
+catalogSnapshots = dict()
+# per engine url scalars computed once per run, ex. the latest weekending of REP_ACCT_FIN_SUMMARY
+runScalars = dict()
+catalogLock = threading.Lock()
+
+def getCatalogSnapshot(engine, tables, refresh=False):
+    '''Returns {table_name: set of column names} of tables fetched with a single all_tab_columns query.
+    The snapshot is cached per engine url and set of tables.'''
+    tables = tuple(sorted(set(t.upper() for t in tables)))
+    key = (str(engine.url), tables)
+    with catalogLock:
+        if key in catalogSnapshots and not refresh:
+            return catalogSnapshots[key]
     sql = '''
-    select distinct table_name from all_tab_columns 
+    select table_name, column_name from all_tab_columns
     where table_name in ({})
-    and column_name in ({})
-    '''.format(','.join(["'{}'".format(t.upper()) for t in tables]), ','.join(["'{}'".format(c.upper()) for c in columns]))
-    #print(sql)
-    result = engine.execute(sql)
-    tabs = [r[0] for r in result]
+    '''.format(','.join(["'{}'".format(t) for t in tables]))
+    snapshot = defaultdict(set)
+    for tableName, columnName in engine.execute(sql):
+        snapshot[tableName].add(columnName)
+    snapshot = dict(snapshot)
+    with catalogLock:
+        catalogSnapshots[key] = snapshot
+    return snapshot
+
+def getRunScalar(engine, name, getter):
+    '''Returns the scalar name of engine computed by getter on the first call and memoized after that'''
+    key = (str(engine.url), name)
+    with catalogLock:
+        if key in runScalars:
+            return runScalars[key]
+    value = getter()
+    with catalogLock:
+        runScalars[key] = value
+    return value
+
+def clearCatalogCache():
+    with catalogLock:
+        catalogSnapshots.clear()
+        runScalars.clear()
+
+def filterTablesByColumns(engine, tables, columns):
+    snapshot = getCatalogSnapshot(engine, tables)
+    upperColumns = set(c.upper() for c in columns)
+    tabs = [t for t in sorted(snapshot) if snapshot[t] & upperColumns]
     if 'IBUSER_RTAB' in tabs:
         tabs.append('CUSTOMERACCOUNTUSERS_RTAB')    
     if 'INDIVIDUAL_RTAB' in tabs:
@@ -330,38 +1473,59 @@ def filterTablesByColumns(engine, tables, columns):
         tabs.append('CUSTOMERACCOUNT_RTAB')
     if 'acct_country' or 'acct_region' in [c.lower() for c in columns]:
         tabs.append('APPLICANT_RTAB')
-    # conn.close()
     return tabs
 
 def checkIfColumnsInTables(engine, tables, columns, dummyColumns):
-    sql = '''
-    select count(1) cnt from all_tab_columns
-    where table_name in ({})
-    and column_name = upper(:1)
-    '''.format(','.join(["'{}'".format(t.upper()) for t in tables]))
+    snapshot = getCatalogSnapshot(engine, tables)
+    tableColumns = set()
+    for t in snapshot:
+        tableColumns |= snapshot[t]
 
     unknownColumns = list()
 
     for column in columns:
-        res = engine.execute(sql, column)
-        cnt = res.fetchone()[0]
-
-        if cnt == 0 and column not in dummyColumns:
+        if column.upper() not in tableColumns and column not in dummyColumns:
             unknownColumns.append(column)
     if len(unknownColumns) > 0:
         raise Exception('Unknown column(s): {}'.format(unknownColumns))
 
-def getDfFromTableObj(pd, sa, engine, tableName, series, allColumns, columns):
+def keyValues(sa, series):
+    '''Returns the values for an in_ filter: the series as a list or the select of the staged keys as is'''
+    if isinstance(series, sa.sql.ClauseElement):
+        return series
+    return series.tolist()
+
+# session scoped table the keys of getAcctsProperties(stageKeys=True) are bulk loaded in
+KEY_STAGE_TABLE = 'ACCT_KEY_STAGE'
+
+def getKeyStageTable(sa, engine, conn):
+    '''Returns the key staging global temporary table. It is created if it doesn't exist'''
+    exists = conn.execute(sa.text("select count(1) from user_tables where table_name = :name"), name=KEY_STAGE_TABLE).scalar()
+    if exists == 0:
+        conn.execute('''create global temporary table {} (
+                        key_set varchar2(30),
+                        key_id varchar2(100))
+                        on commit preserve rows'''.format(KEY_STAGE_TABLE))
+    return getTableObj(sa, engine, KEY_STAGE_TABLE)
+
+def loadStagedKeys(sa, conn, stageTable, keySet, series):
+    '''Bulk loads the keys of series as keySet in the staging table with one array bind insert
+    and returns the select of the staged keys to be used in in_ filters'''
+    conn.execute(stageTable.delete().where(stageTable.c.key_set == keySet))
+    keys = [{'key_set': keySet, 'key_id': str(k)} for k in series.dropna().unique()]
+    if keys:
+        conn.execute(stageTable.insert(), keys)
+    return sa.select([stageTable.c.key_id]).where(stageTable.c.key_set == keySet)
+
+def getDfFromTableObj(pd, sa, engine, tableName, series, allColumns, columns, conn=None, arraysize=None):
     df = None
     needsJoin = False
     
     selectedColumns = None
     colLength = 0
     
-    metadata = sa.MetaData(bind=engine)
-
     if tableName in ['CUSTOMER', 'UNIVERSALACCOUNT', 'ACCOUNT']:
-        tableObj = sa.Table(tableName.upper(), metadata, schema='test', autoload=True)
+        tableObj = getTableObj(sa, engine, tableName.upper(), schema='test')
         selectedColumns = [c for c in tableObj.columns if c.name in allColumns]
         colLength = len([c for c in tableObj.columns if c.name in columns])     
         if 'acct_type' in columns:
@@ -386,13 +1550,13 @@ def getDfFromTableObj(pd, sa, engine, tableName, series, allColumns, columns):
             selectedColumns.append(is_ecp)
                
         df = pd.DataFrame(columns=['acct_id'])
-        filter_ = tableObj.c.acct_id.in_(series.tolist())
+        filter_ = tableObj.c.acct_id.in_(keyValues(sa, series))
     elif tableName == 'APPLICANT_RTAB':
-        tableObj = sa.Table(tableName.upper(), metadata, schema='test', autoload=True)
+        tableObj = getTableObj(sa, engine, tableName.upper(), schema='test')
         selectedColumns = [c for c in tableObj.columns if c.name in allColumns]
         colLength = len([c for c in tableObj.columns if c.name in columns])
         df = pd.DataFrame(columns=['id'])
-        filter_ = tableObj.c.id.in_(series.tolist())
+        filter_ = tableObj.c.id.in_(keyValues(sa, series))
         if 'acct_country' in columns:
             colLength += 1
             # pa_rep_cust_fns.getCountryLabel(upper(nvl(country_of_legal_res,country)))
@@ -405,18 +1569,18 @@ def getDfFromTableObj(pd, sa, engine, tableName, series, allColumns, columns):
             selectedColumns.append(acct_region)
 
     elif tableName == 'ACCOUNT':
-        tableObj = sa.Table(tableName.upper(), metadata, schema='test', autoload=True)
+        tableObj = getTableObj(sa, engine, tableName.upper(), schema='test')
         selectedColumns = [c for c in tableObj.columns if c.name in allColumns]
         colLength = len([c for c in tableObj.columns if c.name in columns])
         df = pd.DataFrame(columns=['sub_acct_id'])
-        filter_ = tableObj.c.sub_acct_id.in_(series.tolist())
+        filter_ = tableObj.c.sub_acct_id.in_(keyValues(sa, series))
     elif tableName == 'CUSTOMERACCOUNTUSER':
-        tableObj = sa.Table(tableName.upper(), metadata, schema='test', autoload=True)
+        tableObj = getTableObj(sa, engine, tableName.upper(), schema='test')
         selectedColumns = [c for c in tableObj.columns if c.name in allColumns]
         colLength = len([c for c in tableObj.columns if c.name in columns])
         df = pd.DataFrame(columns=['acct_id'])
-        filter_ = tableObj.c.acct_id.in_(series.tolist())
-        ibUserObj = sa.Table('USER', metadata, schema='test', autoload=True)
+        filter_ = tableObj.c.acct_id.in_(keyValues(sa, series))
+        ibUserObj = getTableObj(sa, engine, 'USER', schema='test')
         joinClause = tableObj.c.user_id == ibUserObj.c.id
         needsJoin = True
         moreColumns = [c for c in ibUserObj.columns if c.name in columns]
@@ -424,31 +1588,31 @@ def getDfFromTableObj(pd, sa, engine, tableName, series, allColumns, columns):
         selectedColumns.extend(moreColumns)
 #         print(selectedColumns)
     elif tableName == 'ENTITY':
-        tableObj = sa.Table(tableName.upper(), metadata, schema='test', autoload=True)
+        tableObj = getTableObj(sa, engine, tableName.upper(), schema='test')
         selectedColumns = [c for c in tableObj.columns if c.name in allColumns]
         colLength = len([c for c in tableObj.columns if c.name in columns])
         df = pd.DataFrame(columns=['applicant_id'])
-        filter_ = tableObj.c.applicant_id.in_(series.tolist())
+        filter_ = tableObj.c.applicant_id.in_(keyValues(sa, series))
 
-        indivObj = sa.Table('INDIVIDUAL_RTAB', metadata, schema='test', autoload=True)
+        indivObj = getTableObj(sa, engine, 'INDIVIDUAL_RTAB', schema='test')
         joinClause = tableObj.c.entity_id == indivObj.c.id
         needsJoin = True
         moreColumns = [c for c in indivObj.columns if c.name in columns]
         colLength += len(moreColumns)
         selectedColumns.extend(moreColumns)
     elif tableName == 'REP_ACCT_FIN_SUMMARY':
-        tableObj = sa.Table('REP_ACCT_FIN_SUMMARY'.upper(), metadata, autoload=True)
+        tableObj = getTableObj(sa, engine, 'REP_ACCT_FIN_SUMMARY'.upper())
         selectedColumns = [c for c in tableObj.columns if c.name in allColumns]
         colLength = len([c for c in tableObj.columns if c.name in columns])
         df = pd.DataFrame(columns=['acct_id'])
-        maxDt = sa.func.max(tableObj.c.weekending_latest).execute().fetchone()[0]
-        filter_ = (tableObj.c.acct_id.in_(series.tolist())) & (tableObj.c.weekending_latest == maxDt)
+        maxDt = getRunScalar(engine, 'REP_ACCT_FIN_SUMMARY.max(weekending_latest)', lambda: sa.func.max(tableObj.c.weekending_latest).execute().fetchone()[0])
+        filter_ = (tableObj.c.acct_id.in_(keyValues(sa, series))) & (tableObj.c.weekending_latest == maxDt)
     elif tableName == 'ACCT_CASH_BAL_SUMM':
-        tableObj = sa.Table(tableName.upper(), metadata, autoload=True)
+        tableObj = getTableObj(sa, engine, tableName.upper())
         selectedColumns = [c for c in tableObj.columns if c.name in allColumns]
         colLength = len([c for c in tableObj.columns if c.name in columns])        
         df = pd.DataFrame(columns=['acct_id'])
-        filter_ = tableObj.c.acct_id.in_(series.tolist())
+        filter_ = tableObj.c.acct_id.in_(keyValues(sa, series))
 
     if tableName == 'CUSTOMERACCOUNT_RTAB':
         colLength = len(selectedColumns)
@@ -456,95 +1620,93 @@ def getDfFromTableObj(pd, sa, engine, tableName, series, allColumns, columns):
     # print(colLength)
     if colLength > 0:
         # print(tableObj.name, ':', selectedColumns)
+        s = sa.select(selectedColumns, filter_)
         if needsJoin:
-            selectObj = sa.select(selectedColumns, filter_).where(joinClause).execute()
-        else:
-            selectObj = sa.select(selectedColumns, filter_).execute()
-        df = pd.DataFrame(selectObj.fetchall(), columns=selectObj.keys())
+            s = s.where(joinClause)
+        if arraysize is not None:
+            s = s.execution_options(stream_results=True)
+        with metrics.span(tableName) as tableSpan:
+            # the staged keys are only visible in the session of conn
+            selectObj = s.execute() if conn is None else conn.execute(s)
+            if arraysize is None:
+                df = pd.DataFrame(selectObj.fetchall(), columns=selectObj.keys())
+            else:
+                df = resultToDataFrame(selectObj, chunksize=arraysize, arraysize=arraysize)
+            tableSpan.add(rows=len(df), roundTrips=1)
 
         return df
     else:
         return None
 
-@timeit
-def getAccts(engine, filterDict, asSql=False, includeFilterColumns=False):
-    '''Function for getting list of acct_ids based on a filter parsed as dictionary with syntax similar to elastic search
-    usage: df = getAccts(engine, filterDict)
-    ex: filterDict = {"or" : {
-                    "clearing_status" :  "O",
-                    "applicant_rtab.type" : "ORG"
-                },
-                "and" : {
-                    "customeraccount_rtab.phylum_code" : {
-                        "in" : ["C", "D"]
-                    },
-                    "rep_dim_acct.day_begun": {
-                        "between": (20160801, 20160820)
-                    },
-                    "rep_dim_acct.acct_id": {
-                        "in" : sa.text("select acct_id from customerAccount where rownum < 6")
-                    }
-                }
-            }
-    '''
-    import sqlalchemy as sa
-    from pandas import DataFrame
+# compiled getAccts statements keyed by engine url, includeFilterColumns and the shape of the filter
+acctsQueryCache = dict()
+acctsQueryLock = threading.Lock()
 
-    """ Valid operators """
-    OPERATORS = {
-        'like': lambda f, a: f.like(a),
-        'equals': lambda f, a: f == a,
-        'is_null': lambda f: f is None,
-        'is_not_null': lambda f: f is not None,
-        'gt': lambda f, a: f > a,
-        'gte': lambda f, a: f >= a,
-        'lt': lambda f, a: f < a,
-        'lte': lambda f, a: f <= a,
-        'in': lambda f, a: f.in_(a),
-        'not_in': lambda f, a: ~f.in_(a),
-        'not_equal': lambda f, a: f != a,
-        'between': lambda f, a: f.between(*a),
-        'acct_country': lambda f, a: sa.func.pa_rep_cust_fns.fn_getaccappcntry(f) == a
-        }
-    
-    def verify_operator(operator):
-        """ Verify if the operator is valid """
-        try:
-            if operator in OPERATORS:
-                return True
+def parseAcctsFilter(sa, filterDict):
+    '''Parses a getAccts filterDict into its shape and the bind parameters.
+    The shape is a tuple of (group, field, operator, bind) items where group is 'or', 'and' or None,
+    bind is 'scalar', 'list', 'pair', 'none' or the sql text of a clause value (it can't be bound).
+    Params are named p0, p1, ... in the order of the filter.'''
+    shape = list()
+    params = dict()
+    clauses = dict()
+    for filter_type in filterDict:
+        if filter_type == 'or' or filter_type == 'and':
+            group = filter_type
+            fields = filterDict[filter_type].items()
+        else:
+            group = None
+            fields = [(filter_type, filterDict[filter_type])]
+        for field, field_value in fields:
+            if type(field_value) is dict:
+                operator = list(field_value.keys())[0]
+                if operator not in ACCTS_OPERATORS:
+                    raise Exception("Error: operator {} does no exist".format(operator))
+                value = field_value[operator]
             else:
-                return False
-        except KeyError:
-            return False
-        
-    def parse_field(field, field_value):
-        """ Parse the operators and traduce: ES to SQLAlchemy operators """
-        if type(field_value) is dict:
-            operator = list(field_value.keys())[0]
-    #         print(operator, verify_operator(operator))
-            if verify_operator(operator) is False:
-                raise Exception("Error: operator {} does no exist".format(operator))
-            value = field_value[operator]
-        elif type(field_value) is str:
-            operator = 'equals'
-            value = field_value
-        return field, operator, value
-    
-    def create_query(tableObj, attr):
-        """ Mix all values and make the query """
-        field = attr[0]
-        operator = attr[1]
-        value = attr[2]
-        
-        col = eval('tableObj.c.{}'.format(field))
-        return OPERATORS[operator](col, value)
-    
-    # engine = getDbConnection('ORAI', asEngine=True)
-    metadata = sa.MetaData(bind=engine)
-    
-    customeraccount_rtab = sa.Table('customeraccount_rtab'.upper(), metadata, autoload=True).alias('ca')
-    applicant_rtab = sa.Table('applicant_rtab'.upper(), metadata, autoload=True).alias('ap')
-    rep_dim_acct = sa.Table('rep_dim_acct'.upper(), metadata, autoload=True).alias('rda')
+                operator = 'equals'
+                value = field_value
+            name = 'p{}'.format(len(shape))
+            if operator in ('is_null', 'is_not_null'):
+                bind = 'none'
+            elif isinstance(value, sa.sql.ClauseElement):
+                bind = str(value)
+                clauses[name] = value
+            elif operator in ('in', 'not_in'):
+                bind = 'list'
+                params[name] = list(value)
+            elif operator == 'between':
+                bind = 'pair'
+                params[name + '_0'], params[name + '_1'] = value
+            else:
+                bind = 'scalar'
+                params[name] = value
+            shape.append((group, field, operator, bind))
+    return tuple(shape), params, clauses
+
+# operators of the getAccts filters. f is the column and a the bind parameter (or clause)
+ACCTS_OPERATORS = {
+    'like': lambda sa, f, a: f.like(a),
+    'equals': lambda sa, f, a: f == a,
+    'is_null': lambda sa, f, a: f.is_(None),
+    'is_not_null': lambda sa, f, a: f.isnot(None),
+    'gt': lambda sa, f, a: f > a,
+    'gte': lambda sa, f, a: f >= a,
+    'lt': lambda sa, f, a: f < a,
+    'lte': lambda sa, f, a: f <= a,
+    'in': lambda sa, f, a: f.in_(a),
+    'not_in': lambda sa, f, a: ~f.in_(a),
+    'not_equal': lambda sa, f, a: f != a,
+    'between': lambda sa, f, a: f.between(*a),
+    'acct_country': lambda sa, f, a: sa.func.pa_rep_cust_fns.fn_getaccappcntry(f) == a
+    }
+
+def compileAcctsQuery(sa, engine, shape, clauses, includeFilterColumns):
+    '''Builds the getAccts select for a filter shape with bind parameters in place of the values'''
+    customeraccount_rtab = getTableObj(sa, engine, 'customeraccount_rtab'.upper()).alias('ca')
+    applicant_rtab = getTableObj(sa, engine, 'applicant_rtab'.upper()).alias('ap')
+    rep_dim_acct = getTableObj(sa, engine, 'rep_dim_acct'.upper()).alias('rda')
+    tables = {'customeraccount_rtab': customeraccount_rtab, 'applicant_rtab': applicant_rtab, 'rep_dim_acct': rep_dim_acct}
     
     customerAccount_cols = customeraccount_rtab.columns.keys()
     applicant_cols = applicant_rtab.columns.keys()
@@ -554,88 +1716,57 @@ def getAccts(engine, filterDict, asSql=False, includeFilterColumns=False):
     needRepDimAcctJoin = False
     q = []
     cols = list()
-    for filter_type in filterDict:
-        if filter_type == 'or' or filter_type == 'and':
-            conditions = []
-            for field in filterDict[filter_type]:
-                table_name = None
-                if '.' in field:
-                    fieldTmp = field.split('.')
-                    table_name = fieldTmp[0]
-                    field_ = fieldTmp[1]
-                    if table_name == 'applicant_rtab':
-                        needApplicantJoin = True
-                    elif table_name == 'rep_dim_acct':
-                        needRepDimAcctJoin = True
-                    
-                    field, operator, value = parse_field(field, filterDict[filter_type][field])
-                    # print(field_, operator, value)
-                    col = eval('{}.c.{}'.format(table_name, field_))
-                    cols.append(col)
-                    conditions.append(OPERATORS[operator](col, value))
-                    
-                    continue
-                    
-                attr = parse_field(field, filterDict[filter_type][field])
-                if field in customerAccount_cols and (field in applicant_cols or field in rep_dim_acct_cols):
-                    raise Exception('Column {} available in more than 1 table'.format(field))
-                elif field in applicant_cols and (field in customerAccount_cols or field in rep_dim_acct_cols):
-                    raise Exception('Column {} available in more than 1 table'.format(field))
-                elif field in customerAccount_cols:
-                    # print('Column is from {} table'.format(customeraccount_rtab))
-                    # print(attr)
-                    cols.append(eval('{}.c.{}'.format(customeraccount_rtab, field)))
-                    conditions.append(create_query(customeraccount_rtab, attr))
-                elif field in applicant_cols:
-                    # print('Column {} is from {} table'.format(field, applicant_rtab))
-                    cols.append(eval('{}.c.{}'.format(applicant_rtab, field)))
-                    conditions.append(create_query(applicant_rtab, attr))
-                    needApplicantJoin = True
-                elif field in rep_dim_acct_cols:
-                    cols.append(eval('{}.c.{}'.format(rep_dim_acct, field)))
-                    conditions.append(create_query(rep_dim_acct, attr))
-                    needRepDimAcctJoin = True
-                else:
-                    raise Exception('Column {} not available in any of the supported tables'.format(field))
-            if filter_type == 'or':
-                q.append(sa.or_(*conditions))
-            elif filter_type == 'and':
-                # print(conditions)
-                q.append(sa.and_(*conditions))
+    groups = dict()
+    for i, (group, field, operator, bind) in enumerate(shape):
+        if '.' in field:
+            table_name, field_ = field.split('.')
+            tableObj = tables[table_name]
+        else:
+            field_ = field
+            if field in customerAccount_cols and (field in applicant_cols or field in rep_dim_acct_cols):
+                raise Exception('Column {} available in more than 1 table'.format(field))
+            elif field in applicant_cols and (field in customerAccount_cols or field in rep_dim_acct_cols):
+                raise Exception('Column {} available in more than 1 table'.format(field))
+            elif field in customerAccount_cols:
+                table_name = 'customeraccount_rtab'
+            elif field in applicant_cols:
+                table_name = 'applicant_rtab'
+            elif field in rep_dim_acct_cols:
+                table_name = 'rep_dim_acct'
+            else:
+                raise Exception('Column {} not available in any of the supported tables'.format(field))
+            tableObj = tables[table_name]
+        if table_name == 'applicant_rtab':
+            needApplicantJoin = True
+        elif table_name == 'rep_dim_acct':
+            needRepDimAcctJoin = True
+
+        col = tableObj.c[field_]
+        name = 'p{}'.format(i)
+        if bind == 'scalar':
+            value = sa.bindparam(name, type_=col.type)
+        elif bind == 'list':
+            value = sa.bindparam(name, expanding=True)
+        elif bind == 'pair':
+            value = (sa.bindparam(name + '_0', type_=col.type), sa.bindparam(name + '_1', type_=col.type))
+        elif bind == 'none':
+            value = None
+        else:
+            value = clauses[name]
+        cols.append(col)
+        condition = ACCTS_OPERATORS[operator](sa, col, value)
+        if group is None:
+            q.append(condition)
         else:
-            table_name = None
-            if '.' in filter_type:
-                fieldTmp = filter_type.split('.')
-                table_name = fieldTmp[0]
-                field_ = fieldTmp[1]
-                if table_name == 'applicant_rtab':
-                    needApplicantJoin = True
-                elif table_name == 'rep_dim_acct':
-                    needRepDimAcctJoin = True
-                field, operator, value = parse_field(filter_type, filterDict[filter_type])
-                col = eval('{}.c.{}'.format(table_name, field_))
-                cols.append(col)
-                q.append(OPERATORS[operator](col, value))
-                continue  
-            attr = parse_field(filter_type, filterDict[filter_type])
-
-            if filter_type in customerAccount_cols and (filter_type in applicant_cols or filter_type in rep_dim_acct_cols):
-                raise Exception('Column {} available in more than 1 table'.format(filter_type))
-            elif filter_type in applicant_cols and (filter_type in customerAccount_cols or filter_type in rep_dim_acct_cols):
-                raise Exception('Column {} available in more than 1 table'.format(filter_type))
-            elif filter_type in customerAccount_cols:
-                cols.append(eval('{}.c.{}'.format(customeraccount_rtab, field)))
-                q.append(create_query(customeraccount_rtab, attr))
-            elif filter_type in applicant_cols:
-                cols.append(eval('{}.c.{}'.format(applicant_rtab, field)))
-                q.append(create_query(applicant_rtab, attr))
-                needApplicantJoin = True
-            elif filter_type in rep_dim_acct_cols:
-                cols.append(eval('{}.c.{}'.format(rep_dim_acct, filter_type)))
-                q.append(create_query(rep_dim_acct_cols, attr))
-                needRepDimAcctJoin = True
-
-    print(cols)
+            if group not in groups:
+                groups[group] = list()
+                # placeholder keeping the order of the filter, replaced by the group condition
+                q.append(group)
+            groups[group].append(condition)
+    for i, c in enumerate(q):
+        if isinstance(c, str):
+            q[i] = sa.or_(*groups[c]) if c == 'or' else sa.and_(*groups[c])
+
     if includeFilterColumns:
         s = sa.select([customeraccount_rtab.c.acct_id]+cols)
     else:
@@ -654,10 +1785,71 @@ def getAccts(engine, filterDict, asSql=False, includeFilterColumns=False):
     
     for c in q:
         s = s.where(c)
+    return s
+
+def getAcctsQuery(sa, engine, filterDict, includeFilterColumns=False):
+    '''Returns the cached select for the shape of filterDict and its bind parameters'''
+    shape, params, clauses = parseAcctsFilter(sa, filterDict)
+    key = (str(engine.url), includeFilterColumns, shape)
+    with acctsQueryLock:
+        s = acctsQueryCache.get(key)
+    if s is None:
+        s = compileAcctsQuery(sa, engine, shape, clauses, includeFilterColumns)
+        with acctsQueryLock:
+            acctsQueryCache[key] = s
+    return s, params
+
+def iterAccts(engine, filterDict, includeFilterColumns=False, chunksize=50000, arraysize=None):
+    '''Streaming version of getAccts. Executes the filter with a server side cursor and yields
+    DataFrames of up to chunksize rows as they arrive. arraysize is the number of rows fetched per round trip.
+
+    Usage: for df in iterAccts(engine, filterDict, chunksize=100000, arraysize=5000):
+               ...
+    '''
+    import sqlalchemy as sa
+
+    s, params = getAcctsQuery(sa, engine, filterDict, includeFilterColumns)
+    res = engine.execute(s.execution_options(stream_results=True), params)
+    for df in iterResultFrames(res, chunksize, arraysize or chunksize):
+        yield df
+
+@timeit
+def getAccts(engine, filterDict, asSql=False, includeFilterColumns=False, arraysize=None):
+    '''Function for getting list of acct_ids based on a filter parsed as dictionary with syntax similar to elastic search
+    The filter is compiled to a select with bind parameters. The select is cached by the shape of the filter
+    (fields, operators and joins, not the values) and executed again with the new values.
+    If arraysize is given the rows are fetched arraysize at a time from a server side cursor and the
+    frame is built batch by batch. Use iterAccts to process the rows while they arrive.
+    usage: df = getAccts(engine, filterDict)
+    ex: filterDict = {"or" : {
+                    "clearing_status" :  "O",
+                    "applicant_rtab.type" : "ORG"
+                },
+                "and" : {
+                    "customeraccount_rtab.phylum_code" : {
+                        "in" : ["C", "D"]
+                    },
+                    "rep_dim_acct.day_begun": {
+                        "between": (20160801, 20160820)
+                    },
+                    "rep_dim_acct.acct_id": {
+                        "in" : sa.text("select acct_id from customerAccount where rownum < 6")
+                    }
+                }
+            }
+    '''
+    import sqlalchemy as sa
+    from pandas import DataFrame
+
+    s, params = getAcctsQuery(sa, engine, filterDict, includeFilterColumns)
 
     if asSql:
         return str(s)
 #     sys.exit()
-    res = s.execute()
-    df = DataFrame(res.fetchall(), columns=res.keys())
-    return df
\ No newline at end of file
+    if arraysize is None:
+        res = engine.execute(s, params)
+        df = DataFrame(res.fetchall(), columns=res.keys())
+    else:
+        res = engine.execute(s.execution_options(stream_results=True), params)
+        df = resultToDataFrame(res, chunksize=arraysize, arraysize=arraysize)
+    return df